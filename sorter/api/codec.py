@@ -0,0 +1,146 @@
+import struct
+import zlib
+
+import numpy as np
+import orjson
+
+from sorter.api.engine import ItineraryColumns, SortedItineraries, serialize_rows
+from sorter.api.metrics import stage
+from sorter.api.rates import RateTable, get_rate_table
+
+# Itineraries per encoded chunk, reading a page only decompresses and decodes the chunks it overlaps
+CHUNK_SIZE = 256
+# zlib level, the fastest one already shrinks the columns several times
+COMPRESSION_LEVEL = 1
+
+# Itineraries, characters per id and bytes of the currency dictionary in a chunk
+_HEADER = struct.Struct("<III")
+
+
+def _encode_chunk(
+    ids: np.ndarray,
+    durations: np.ndarray,
+    amounts: np.ndarray,
+    currencies: np.ndarray,
+    currency_names: np.ndarray,
+) -> bytes:
+    # Every chunk has its own dictionary of the currencies it holds, stored as positions into it
+    used, codes = np.unique(currencies, return_inverse=True)
+    dictionary = ",".join(currency_names[used].tolist()).encode()
+    ids = np.ascontiguousarray(ids, dtype=f"<U{max(ids.dtype.itemsize // 4, 1)}")
+    return zlib.compress(b"".join((
+        _HEADER.pack(len(ids), ids.dtype.itemsize // 4, len(dictionary)),
+        dictionary,
+        codes.astype(np.uint16).tobytes(),
+        durations.astype(np.int64).tobytes(),
+        amounts.astype(np.float64).tobytes(),
+        ids.tobytes(),
+    )), COMPRESSION_LEVEL)
+
+
+def encode(sorted_itineraries: SortedItineraries | list[bytes], chunk_size: int = CHUNK_SIZE) -> list[bytes]:
+    """
+    Encode sorted itineraries into compressed chunks of `chunk_size` itineraries, each holding the
+    ids, durations, amounts and currencies of its itineraries as columns. Itineraries already
+    serialized to JSON are parsed back first.
+    """
+    with stage("serialization"):
+        if isinstance(sorted_itineraries, SortedItineraries):
+            columns, order = sorted_itineraries.columns, sorted_itineraries.order
+            ids, durations, amounts = columns.ids[order], columns.durations[order], columns.amounts[order]
+            currencies = columns.currencies[order]
+            currency_names = np.asarray(columns.rate_table.currencies)
+        else:
+            itineraries = [orjson.loads(item) for item in sorted_itineraries]
+            ids = np.array([itinerary["id"] for itinerary in itineraries], dtype=str)
+            durations = np.array([itinerary["duration_minutes"] for itinerary in itineraries], dtype=np.int64)
+            amounts = np.array([itinerary["price"]["amount"] for itinerary in itineraries], dtype=np.float64)
+            currency_names, currencies = np.unique(
+                np.array([itinerary["price"]["currency"] for itinerary in itineraries], dtype=str),
+                return_inverse=True,
+            )
+
+        return [
+            _encode_chunk(
+                ids[start:start + chunk_size],
+                durations[start:start + chunk_size],
+                amounts[start:start + chunk_size],
+                currencies[start:start + chunk_size],
+                currency_names,
+            )
+            for start in range(0, len(ids), chunk_size)
+        ]
+
+
+def _read_chunk(chunk: bytes) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Currency names, then the codes, durations, amounts and ids columns read straight from the buffer
+    data = zlib.decompress(chunk)
+    count, id_length, dictionary_size = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    names = data[offset:offset + dictionary_size].decode().split(",") if dictionary_size else []
+    offset += dictionary_size
+
+    columns = []
+    for dtype in (np.uint16, np.int64, np.float64, f"<U{id_length}"):
+        column = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += column.nbytes
+        columns.append(column)
+    return names, *columns
+
+
+def _decode_chunk(chunk: bytes, start: int, end: int, fields: list[str] | None) -> list[bytes]:
+    names, codes, durations, amounts, ids = _read_chunk(chunk)
+    codes, durations, amounts, ids = codes[start:end], durations[start:end], amounts[start:end], ids[start:end]
+    currencies = [names[code] for code in codes.tolist()]
+    return serialize_rows(zip(ids.tolist(), durations.tolist(), amounts.tolist(), currencies), fields)
+
+
+def decode(
+    chunks: list[bytes],
+    start: int,
+    end: int,
+    chunk_size: int = CHUNK_SIZE,
+    fields: list[str] | None = None,
+) -> list[bytes]:
+    """
+    Serialize the itineraries in [start, end) of consecutive chunks to JSON, the same items `encode` was
+    given, with `fields` only those fields. Positions count from the first chunk, only the itineraries
+    in the range are decoded.
+    """
+    items = []
+    for index, chunk in enumerate(chunks):
+        chunk_start = index * chunk_size
+        if chunk_start + chunk_size <= start or chunk_start >= end:
+            continue
+        items.extend(_decode_chunk(chunk, max(start - chunk_start, 0), end - chunk_start, fields))
+    return items
+
+
+def encode_columns(columns: ItineraryColumns) -> bytes:
+    """
+    Encode itinerary columns as one compressed chunk, in their order, e.g. to store a request and sort it later.
+    """
+    with stage("serialization"):
+        return _encode_chunk(
+            columns.ids,
+            columns.durations,
+            columns.amounts,
+            columns.currencies,
+            np.asarray(columns.rate_table.currencies),
+        )
+
+
+def decode_columns(chunk: bytes, rate_table: RateTable | None = None) -> ItineraryColumns:
+    """
+    Decode columns encoded by `encode_columns`, their currencies are mapped to positions in `rate_table`.
+    """
+    rate_table = rate_table or get_rate_table()
+    names, codes, durations, amounts, ids = _read_chunk(chunk)
+    currencies = rate_table.currency_codes(names) if names else np.empty(0, dtype=np.int16)
+    return ItineraryColumns(
+        ids=ids,
+        durations=durations,
+        amounts=amounts,
+        currencies=currencies[codes],
+        rate_table=rate_table,
+    )
@@ -0,0 +1,579 @@
+import hashlib
+import json
+from collections.abc import Sequence
+
+import numpy as np
+import orjson
+
+from sorter.api.metrics import stage
+from sorter.api.rates import get_rate_table, RateTable
+from sorter.api.utils import convert_prices, normalize, weighted_scores
+
+
+def serialize_rows(rows, fields: Sequence[str] | None = None) -> list[bytes]:
+    """
+    Serialize (id, duration, amount, currency name) tuples to JSON the way the `Itinerary` response model renders them,
+    with `fields` only those fields of each itinerary.
+    """
+    dumps = orjson.dumps
+    items = (
+        {
+            "id": itinerary_id,
+            "duration_minutes": duration,
+            "price": {"amount": amount, "currency": currency},
+        }
+        for itinerary_id, duration, amount, currency in rows
+    )
+    if fields:
+        return [dumps({field: item[field] for field in fields}) for item in items]
+    return [dumps(item) for item in items]
+
+
+class ItineraryColumns:
+    """
+    Itineraries held as typed NumPy columns, one entry per itinerary.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        durations: np.ndarray,
+        amounts: np.ndarray,
+        currencies: np.ndarray,
+        rate_table: RateTable | None = None,
+    ):
+        self.ids = ids
+        self.durations = durations
+        self.amounts = amounts
+        # Positions of the currencies in `rate_table.currencies`
+        self.currencies = currencies
+        self.rate_table = rate_table or get_rate_table()
+        self._price_eur = None
+        self._normalized = None
+        # Float32 buffers "best" scores are written to, reused by every rescoring
+        self._score_buffers = None
+        self._row_hashes = None
+
+    @classmethod
+    def from_itineraries(cls, itineraries, rate_table: RateTable | None = None) -> "ItineraryColumns":
+        """
+        Build the columns from parsed `Itinerary` models.
+        """
+        rate_table = rate_table or get_rate_table()
+        return cls(
+            ids=np.array([itinerary.id for itinerary in itineraries], dtype=str),
+            durations=np.array([itinerary.duration_minutes for itinerary in itineraries], dtype=np.int64),
+            amounts=np.array([itinerary.price.amount for itinerary in itineraries], dtype=np.float64),
+            currencies=rate_table.currency_codes([itinerary.price.currency for itinerary in itineraries]),
+            rate_table=rate_table,
+        )
+
+    @classmethod
+    def concatenate(cls, parts: list["ItineraryColumns"], rate_table: RateTable | None = None) -> "ItineraryColumns":
+        """
+        Join columns built in parts, the parts must share `rate_table`.
+        """
+        if not parts:
+            return cls(
+                ids=np.array([], dtype=str),
+                durations=np.array([], dtype=np.int64),
+                amounts=np.array([], dtype=np.float64),
+                currencies=np.array([], dtype=np.int16),
+                rate_table=rate_table,
+            )
+        return cls(
+            ids=np.concatenate([part.ids for part in parts]),
+            durations=np.concatenate([part.durations for part in parts]),
+            amounts=np.concatenate([part.amounts for part in parts]),
+            currencies=np.concatenate([part.currencies for part in parts]),
+            rate_table=rate_table or parts[0].rate_table,
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def take(self, positions: np.ndarray) -> "ItineraryColumns":
+        """
+        Columns of the itineraries at the given positions, in that order, prices already converted are kept.
+        """
+        columns = ItineraryColumns(
+            ids=self.ids[positions],
+            durations=self.durations[positions],
+            amounts=self.amounts[positions],
+            currencies=self.currencies[positions],
+            rate_table=self.rate_table,
+        )
+        if self._price_eur is not None:
+            columns._price_eur = self._price_eur[positions]
+        if self._row_hashes is not None:
+            columns._row_hashes = self._row_hashes[positions]
+        return columns
+
+    @property
+    def price_eur(self) -> np.ndarray:
+        if self._price_eur is None:
+            with stage("conversion"):
+                self._price_eur = convert_prices(self.amounts, self.currencies, self.rate_table)
+        return self._price_eur
+
+    @property
+    def normalized(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Prices in EUR and durations normalized to [0, 1], computed once and shared by "best" scores
+        with any weights.
+        """
+        if self._normalized is None:
+            normalized = np.empty((2, len(self)), dtype=np.float32)
+            normalize(self.price_eur, out=normalized[0])
+            normalize(self.durations, out=normalized[1])
+            self._normalized = (normalized[0], normalized[1])
+        return self._normalized
+
+    @property
+    def row_hashes(self) -> np.ndarray:
+        """
+        A 64-bit hash of each itinerary's id, duration, price and currency, equal itineraries hash the same.
+        """
+        if self._row_hashes is None:
+            with stage("fingerprint"):
+                self._row_hashes = hash_rows(self)
+        return self._row_hashes
+
+    def scores(self, price_weight: float = 0.5, duration_weight: float = 0.5) -> np.ndarray:
+        """
+        "best" scores of the itineraries, lower is better. They are written to a buffer kept on the columns,
+        so the returned array is only valid until the next call.
+        """
+        if self._score_buffers is None:
+            self._score_buffers = np.empty((2, len(self)), dtype=np.float32)
+        return weighted_scores(*self.normalized, price_weight, duration_weight, *self._score_buffers)
+
+    def rows(self, positions: np.ndarray):
+        """
+        Iterate (id, duration, amount, currency name) tuples for the itineraries at the given positions.
+        """
+        currency_names = self.rate_table.currencies
+        return zip(
+            self.ids[positions].tolist(),
+            self.durations[positions].tolist(),
+            self.amounts[positions].tolist(),
+            [currency_names[currency] for currency in self.currencies[positions].tolist()],
+        )
+
+    def records(self, positions: np.ndarray) -> list[dict]:
+        """
+        Build response items for the itineraries at the given positions.
+        """
+        return [
+            {
+                "id": itinerary_id,
+                "duration_minutes": duration,
+                "price": {
+                    "amount": str(amount),
+                    "currency": currency,
+                },
+            }
+            for itinerary_id, duration, amount, currency in self.rows(positions)
+        ]
+
+    def serialize(self, positions: np.ndarray, fields: Sequence[str] | None = None) -> list[bytes]:
+        """
+        Serialize the itineraries at the given positions to JSON, each item is rendered the way
+        the `Itinerary` response model renders it, so pages can be stitched from the fragments.
+        """
+        with stage("serialization"):
+            return serialize_rows(self.rows(positions), fields)
+
+
+class SortedItineraries(Sequence):
+    """
+    Sorted view over `ItineraryColumns`, response items are only built for the slices that are read.
+    With `fields` the items only hold those fields.
+    """
+
+    def __init__(self, columns: ItineraryColumns, order: np.ndarray, fields: Sequence[str] | None = None):
+        self.columns = columns
+        self.order = order
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        positions = self.order[index] if isinstance(index, slice) else self.order[[index]]
+        records = self.columns.records(positions)
+        if self.fields:
+            records = [{field: record[field] for field in self.fields} for record in records]
+        return records if isinstance(index, slice) else records[0]
+
+    def serialize(self, index: slice = slice(None)) -> list[bytes]:
+        """
+        JSON fragments of the sorted itineraries in `index`, see `ItineraryColumns.serialize`.
+        """
+        return self.columns.serialize(self.order[index], self.fields)
+
+
+# splitmix64 finalizer, mixes each field into the row hashes
+_MIX_SHIFTS = (np.uint64(30), np.uint64(27), np.uint64(31))
+_MIX_MULTIPLIERS = (np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+
+def _mix(hashes: np.ndarray, values: np.ndarray):
+    hashes ^= values
+    hashes ^= hashes >> _MIX_SHIFTS[0]
+    hashes *= _MIX_MULTIPLIERS[0]
+    hashes ^= hashes >> _MIX_SHIFTS[1]
+    hashes *= _MIX_MULTIPLIERS[1]
+    hashes ^= hashes >> _MIX_SHIFTS[2]
+
+
+def _word_multipliers(count: int) -> np.ndarray:
+    # A distinct odd multiplier per word position, so reordered words hash differently
+    multipliers = np.arange(1, count + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    multipliers ^= multipliers >> _MIX_SHIFTS[1]
+    multipliers *= _MIX_MULTIPLIERS[0]
+    return multipliers | np.uint64(1)
+
+
+def _hash_ids(ids: np.ndarray) -> np.ndarray:
+    # Each id is read once, as the 64-bit words of its fixed-width string, and its words are summed
+    # times their multipliers. Padding words are zero and add nothing, and a lone trailing character
+    # reads as the word it would make with padding, so the same ids held in wider strings hash the same.
+    ids = np.ascontiguousarray(ids)
+    count, width = len(ids), ids.dtype.itemsize // 4
+    hashes = np.zeros(count, dtype=np.uint64)
+    multipliers = _word_multipliers((width + 1) // 2)
+    words = np.ndarray((count, width // 2), dtype=np.uint64, buffer=ids, strides=(4 * width, 8))
+    for position in range(width // 2):
+        hashes += words[:, position] * multipliers[position]
+    if width % 2:
+        last = np.ndarray((count,), dtype=np.uint32, buffer=ids, offset=4 * (width - 1), strides=(4 * width,))
+        hashes += last.astype(np.uint64) * multipliers[-1]
+    return hashes
+
+
+def hash_rows(columns: ItineraryColumns) -> np.ndarray:
+    """
+    Hash every itinerary to a uint64 in a few vectorized passes, one per pair of characters of the id column,
+    whose width is bounded by MAX_ID_LENGTH.
+    """
+    if not len(columns):
+        return np.zeros(0, dtype=np.uint64)
+    hashes = _hash_ids(columns.ids)
+    _mix(hashes, columns.durations.astype(np.uint64))
+    _mix(hashes, np.ascontiguousarray(columns.amounts, dtype=np.float64).view(np.uint64))
+    _mix(hashes, columns.currencies.astype(np.uint64))
+    return hashes
+
+
+def canonical(columns: ItineraryColumns) -> ItineraryColumns:
+    """
+    The columns in the order of their row hashes. Sorts are stable, so itineraries with equal keys
+    come out in this order whatever order they were sent in, and clients sharing a cached result
+    see the same ties.
+    """
+    hashes = columns.row_hashes
+    if (hashes[1:] >= hashes[:-1]).all():
+        return columns
+    with stage("fingerprint"):
+        return columns.take(np.argsort(hashes, kind="stable"))
+
+
+def cheapest_key(columns: ItineraryColumns, price_weight: float, duration_weight: float) -> np.ndarray:
+    return columns.price_eur
+
+
+def fastest_key(columns: ItineraryColumns, price_weight: float, duration_weight: float) -> np.ndarray:
+    return columns.durations
+
+
+def best_key(columns: ItineraryColumns, price_weight: float, duration_weight: float) -> np.ndarray:
+    return columns.scores(price_weight, duration_weight)
+
+
+# Key column per sorting type, itineraries are sorted ascending by it
+SORT_KEYS = {
+    "cheapest": cheapest_key,
+    "fastest": fastest_key,
+    "best": best_key,
+}
+
+
+def filter_columns(
+    columns: ItineraryColumns,
+    max_price_eur: float | None = None,
+    min_duration_minutes: int | None = None,
+    max_duration_minutes: int | None = None,
+    currencies: Sequence[str] | None = None,
+    ids: Sequence[str] | None = None,
+) -> ItineraryColumns:
+    """
+    The itineraries matching every given predicate, in the same order.
+    """
+    with stage("filtering"):
+        mask = np.ones(len(columns), dtype=bool)
+        if max_price_eur is not None:
+            mask &= columns.price_eur <= max_price_eur
+        if min_duration_minutes is not None:
+            mask &= columns.durations >= min_duration_minutes
+        if max_duration_minutes is not None:
+            mask &= columns.durations <= max_duration_minutes
+        if currencies is not None:
+            mask &= np.isin(columns.currencies, columns.rate_table.currency_codes(currencies))
+        if ids is not None:
+            mask &= np.isin(columns.ids, np.asarray(ids, dtype=str))
+        if mask.all():
+            return columns
+        return columns.take(np.flatnonzero(mask))
+
+
+def id_key(columns: ItineraryColumns, price_weight: float, duration_weight: float) -> np.ndarray:
+    return columns.ids
+
+
+# Keys the itineraries can be further ordered by when the key of their sorting type ties,
+# prefixed with "-" to order by them descending. The sorting type's key stays first and ascending
+THEN_BY_KEYS = {
+    "price_eur": cheapest_key,
+    "duration": fastest_key,
+    "score": best_key,
+    "id": id_key,
+}
+
+
+def then_by_key(columns: ItineraryColumns, field: str, price_weight: float, duration_weight: float) -> np.ndarray:
+    name = field.removeprefix("-")
+    try:
+        key = THEN_BY_KEYS[name](columns, price_weight, duration_weight)
+    except KeyError:
+        raise ValueError(f"Invalid then_by key {name!r}") from None
+    if not field.startswith("-"):
+        return key
+    if not np.issubdtype(key.dtype, np.number):
+        # Strings can't be negated, their ranks can
+        key = np.unique(key, return_inverse=True)[1]
+    return -key
+
+
+def lexsort(keys: list[np.ndarray]) -> np.ndarray:
+    """
+    Stable sort by `keys` in order of precedence, ties on every key keep their positions.
+    """
+    return np.lexsort(keys[::-1])
+
+
+def top_k(key: np.ndarray, limit: int) -> np.ndarray:
+    """
+    Positions of the `limit` smallest keys in sorted order, in O(n + k log k).
+    The result is always the prefix of the full stable sort, so ties at the window edge
+    are resolved the same way as when the whole key column is sorted.
+    """
+    threshold = np.partition(key, limit - 1)[limit - 1]
+    if np.isnan(threshold):
+        return np.argsort(key, kind="stable")[:limit]
+
+    below = np.flatnonzero(key < threshold)
+    ties = np.flatnonzero(key == threshold)[:limit - len(below)]
+    selected = np.sort(np.concatenate([below, ties]))
+    return selected[np.argsort(key[selected], kind="stable")]
+
+
+def top_k_lexsort(keys: list[np.ndarray], limit: int) -> np.ndarray:
+    """
+    Positions of the first `limit` itineraries in `lexsort(keys)` order, only the itineraries whose
+    first key is within the `limit` smallest are sorted by all keys.
+    """
+    threshold = np.partition(keys[0], limit - 1)[limit - 1]
+    if np.isnan(threshold):
+        return lexsort(keys)[:limit]
+
+    selected = np.flatnonzero(keys[0] <= threshold)
+    return selected[lexsort([key[selected] for key in keys])][:limit]
+
+
+def sort_order(
+    columns: ItineraryColumns,
+    sorting_type: str,
+    price_weight: float = 0.5,
+    duration_weight: float = 0.5,
+    limit: int | None = None,
+    then_by: Sequence[str] = (),
+) -> np.ndarray:
+    """
+    Return the permutation of `columns` positions for the given sorting type,
+    itineraries with the same key are ordered by the `then_by` keys in turn.
+    With `limit` only the first `limit` positions are selected and sorted.
+    """
+    try:
+        key_function = SORT_KEYS[sorting_type]
+    except KeyError:
+        raise ValueError("Invalid sorting_type") from None
+
+    if not len(columns) or (limit is not None and limit <= 0):
+        return np.empty(0, dtype=np.intp)
+
+    # Conversion runs as part of scoring the first time prices are needed
+    with stage("scoring"):
+        keys = [key_function(columns, price_weight, duration_weight)]
+        keys.extend(then_by_key(columns, field, price_weight, duration_weight) for field in then_by)
+    with stage("sorting"):
+        if len(keys) > 1:
+            if limit is not None and limit < len(columns):
+                return top_k_lexsort(keys, limit)
+            return lexsort(keys)
+        if limit is not None and limit < len(columns):
+            return top_k(keys[0], limit)
+        return np.argsort(keys[0], kind="stable")
+
+
+def sort_orders(
+    columns: ItineraryColumns,
+    sorting_types: list[str],
+    price_weight: float = 0.5,
+    duration_weight: float = 0.5,
+    limit: int | None = None,
+    then_by: Sequence[str] = (),
+) -> list[np.ndarray]:
+    """
+    Return the permutation for each of several sorting types of the same columns, see `sort_order`.
+    Prices are converted once and shared by every sorting type that needs them.
+    """
+    return [
+        sort_order(columns, sorting_type, price_weight, duration_weight, limit, then_by)
+        for sorting_type in sorting_types
+    ]
+
+
+def merge_order(
+    columns: ItineraryColumns,
+    sorted_count: int,
+    sorting_type: str,
+    price_weight: float = 0.5,
+    duration_weight: float = 0.5,
+    then_by: Sequence[str] = (),
+    tie_break: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Return the permutation of `columns` positions for columns whose first `sorted_count` itineraries
+    are already in sorted order and the rest were added, in O(n + m log m) for m added itineraries.
+    Keys are computed over all columns, so "best" scores are normalized with the new price and duration
+    ranges, when that puts the sorted itineraries out of order everything is sorted again.
+    The result is the same as the stable sort of the sorted itineraries followed by the added ones,
+    with `tie_break` (e.g. `row_hashes`) itineraries with equal keys are ordered by it instead.
+    With `then_by` keys everything is sorted again.
+    """
+    try:
+        key_function = SORT_KEYS[sorting_type]
+    except KeyError:
+        raise ValueError("Invalid sorting_type") from None
+
+    if not len(columns):
+        return np.empty(0, dtype=np.intp)
+    if then_by:
+        if tie_break is None:
+            return sort_order(columns, sorting_type, price_weight, duration_weight, then_by=then_by)
+        ordered = np.argsort(tie_break, kind="stable")
+        return ordered[sort_order(columns.take(ordered), sorting_type, price_weight, duration_weight, then_by=then_by)]
+
+    with stage("scoring"):
+        key = key_function(columns, price_weight, duration_weight)
+    with stage("sorting"):
+        if tie_break is None:
+            tie_break = np.arange(len(columns))
+        sorted_key, added_key = key[:sorted_count], key[sorted_count:]
+        sorted_ties, added_ties = tie_break[:sorted_count], tie_break[sorted_count:]
+        after = sorted_key[1:] > sorted_key[:-1]
+        tied = sorted_key[1:] == sorted_key[:-1]
+        if not (after | (tied & (sorted_ties[1:] >= sorted_ties[:-1]))).all():
+            return np.lexsort((tie_break, key))
+
+        added_order = np.lexsort((added_ties, added_key))
+        added_key, added_ties = added_key[added_order], added_ties[added_order]
+        positions = np.searchsorted(sorted_key, added_key, side="left")
+        ends = np.searchsorted(sorted_key, added_key, side="right")
+        # Added itineraries tied with sorted ones go among them by `tie_break`
+        for index in np.flatnonzero(ends > positions).tolist():
+            start = positions[index]
+            positions[index] = start + np.searchsorted(sorted_ties[start:ends[index]], added_ties[index], side="right")
+        return np.insert(np.arange(sorted_count), positions, sorted_count + added_order)
+
+
+def _narrowest(ids: np.ndarray) -> np.ndarray:
+    # The same ids held in wider strings, e.g. after joining columns with longer ids, digest the same
+    if not len(ids):
+        return ids
+    ids = np.ascontiguousarray(ids)
+    codes = ids.view(np.uint32).reshape(len(ids), -1)
+    width = codes.shape[1]
+    while width > 1 and not codes[:, width - 1].any():
+        width -= 1
+    return ids if width == codes.shape[1] else ids.astype(f"<U{width}")
+
+
+def fingerprint(
+    columns: ItineraryColumns,
+    sorting_type: str,
+    price_weight: float = 0.5,
+    duration_weight: float = 0.5,
+    then_by: Sequence[str] = (),
+    fields: Sequence[str] | None = None,
+    filters: dict | None = None,
+) -> str:
+    """
+    Deterministic digest of a sort request, independent of the order the itineraries were sent in.
+    Weights only count for "best" scores and the rates version is included so a rates reload invalidates it.
+    The columns are digested after filtering, the `filters` are part of it too since they are applied again
+    to itineraries added to the result.
+    """
+    return fingerprints(columns, [sorting_type], price_weight, duration_weight, then_by, fields, filters)[0]
+
+
+def fingerprints(
+    columns: ItineraryColumns,
+    sorting_types: list[str],
+    price_weight: float = 0.5,
+    duration_weight: float = 0.5,
+    then_by: Sequence[str] = (),
+    fields: Sequence[str] | None = None,
+    filters: dict | None = None,
+) -> list[str]:
+    """
+    The `fingerprint` of the same columns sorted by each of `sorting_types`, the columns are digested
+    once for all of them in `canonical` order. The row hashes only order the rows, every field of every row
+    is digested, so requests holding different itineraries never share a fingerprint.
+    """
+    hashes = columns.row_hashes
+    with stage("fingerprint"):
+        currency_names = np.asarray(columns.rate_table.currencies)[columns.currencies]
+        rows = [_narrowest(columns.ids), columns.durations, columns.amounts, currency_names]
+        # Columns already in `canonical` order have sorted hashes
+        if not (hashes[1:] >= hashes[:-1]).all():
+            order = np.argsort(hashes, kind="stable")
+            rows = [column[order] for column in rows]
+        rows = [np.ascontiguousarray(column).tobytes() for column in rows]
+
+        scored_then_by = any(field.removeprefix("-") == "score" for field in then_by)
+        digests = []
+        for sorting_type in sorting_types:
+            options = {
+                "sorting_type": sorting_type,
+                "weights": [price_weight, duration_weight] if sorting_type == "best" or scored_then_by else None,
+                "rates": columns.rate_table.source_mtime,
+                "total": len(columns),
+            }
+            # Only added when set, so requests without them keep their fingerprints
+            if then_by:
+                options["then_by"] = list(then_by)
+            if fields:
+                options["fields"] = list(fields)
+            if filters:
+                options["filters"] = {
+                    name: sorted(value) if isinstance(value, list) else value
+                    for name, value in sorted(filters.items())
+                }
+            digest = hashlib.sha256()
+            digest.update(json.dumps(options).encode())
+            for column in rows:
+                digest.update(column)
+            digests.append(digest.hexdigest())
+        return digests
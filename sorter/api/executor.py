@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+
+from sorter.api import metrics
+from sorter.config import INLINE_SORT_MAX_ITINERARIES, MAX_CONCURRENT_SORTS, SORT_EXECUTOR, SORT_EXECUTOR_WORKERS
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_MODES = ("inline", "thread", "process")
+
+_executor: Executor | None = None
+# Sorts offloaded to the pool right now, and how many may be at once
+_running = 0
+_max_running = MAX_CONCURRENT_SORTS
+
+
+class Overloaded(Exception):
+    """
+    Every slot for offloaded sorts is taken, the request should be retried later.
+    """
+
+
+def start(
+    mode: str = SORT_EXECUTOR,
+    workers: int = SORT_EXECUTOR_WORKERS,
+    max_running: int = MAX_CONCURRENT_SORTS,
+) -> Executor | None:
+    """
+    Create the pool CPU-bound sorting is offloaded to, called on startup.
+    At most `max_running` sorts are offloaded at once, further ones raise `Overloaded`.
+    """
+    global _executor, _max_running
+    if mode not in EXECUTOR_MODES:
+        raise ValueError(f"Invalid sort executor {mode!r}, expected one of {EXECUTOR_MODES}")
+
+    shutdown()
+    _max_running = max_running
+    if mode == "thread":
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sorter")
+    elif mode == "process":
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Spawned workers don't inherit the event loop, Redis connections or other threads of the API process
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    logger.info(f"Sorting runs {'inline' if _executor is None else f'in a {mode} pool of {workers} workers'}")
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run(func, *args, size: int):
+    """
+    Run CPU-bound `func` off the event loop, payloads of `size` up to INLINE_SORT_MAX_ITINERARIES run inline.
+    With a process pool `func`, its arguments and its result must be picklable.
+    Stages timed by `func` are added to the timings of the current request.
+    Raises `Overloaded` when `max_running` sorts are already offloaded.
+    """
+    global _running
+    if _executor is None or size <= INLINE_SORT_MAX_ITINERARIES:
+        return func(*args)
+    if _running >= _max_running:
+        raise Overloaded(f"{_running} sorts are already running, try again later")
+
+    loop = asyncio.get_running_loop()
+    _running += 1
+    try:
+        result, stages = await loop.run_in_executor(_executor, partial(metrics.timed_call, func, *args))
+    finally:
+        _running -= 1
+    timings = metrics.current()
+    if timings is not None:
+        for name, duration in stages.items():
+            timings.record(name, duration)
+    return result
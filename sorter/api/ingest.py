@@ -0,0 +1,390 @@
+import json
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+
+import numpy as np
+import orjson
+from pydantic import ValidationError
+
+from sorter.api import codec, executor
+from sorter.api.engine import ItineraryColumns, canonical, filter_columns
+from sorter.api.rates import RateTable, get_rate_table
+from sorter.config import MAX_ID_LENGTH
+from sorter.schemas.itinerirary_schemas import BatchSortRequest, Itinerary, SortOptions, SortRequest
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Streamed itineraries are validated and converted to columns this many lines at a time
+NDJSON_BATCH_SIZE = 10_000
+
+
+@dataclass
+class ColumnarSortRequest:
+    """
+    A validated sort request with its itineraries held as columns instead of `Itinerary` models.
+    """
+    sorting_type: str
+    price_weight: float
+    duration_weight: float
+    columns: ItineraryColumns
+    # Decoded request body, kept to schedule the request or sort it again later.
+    # Streamed requests don't keep one, see `as_payload`
+    payload: dict | None
+    then_by: list[str] = field(default_factory=list)
+    # Filters the columns were already filtered with, kept for `as_payload` and to filter added itineraries
+    filters: dict | None = None
+    fields: list[str] | None = None
+
+    @classmethod
+    def from_options(
+        cls,
+        options: SortOptions,
+        columns: ItineraryColumns,
+        payload: dict | None,
+        filtered: bool = False,
+    ) -> "ColumnarSortRequest":
+        """
+        Build a request from validated options, keeping only the itineraries that match its filters
+        unless the `columns` are already `filtered`. The columns are put in `canonical` order.
+        """
+        filters = options.filters.model_dump(exclude_none=True) if options.filters else None
+        if filters and not filtered:
+            columns = filter_columns(columns, **filters)
+        return cls(
+            sorting_type=options.sorting_type,
+            price_weight=options.price_weight,
+            duration_weight=options.duration_weight,
+            columns=canonical(columns),
+            payload=payload,
+            then_by=options.then_by,
+            filters=filters,
+            fields=options.fields,
+        )
+
+    @classmethod
+    def from_model(cls, request: SortRequest, payload: dict | None = None) -> "ColumnarSortRequest":
+        return cls.from_options(
+            request,
+            ItineraryColumns.from_itineraries(request.itineraries),
+            payload if payload is not None else request.model_dump(),
+        )
+
+    def sort_options(self) -> dict:
+        return {
+            "sorting_type": self.sorting_type,
+            "price_weight": self.price_weight,
+            "duration_weight": self.duration_weight,
+            "then_by": self.then_by,
+            "filters": self.filters,
+            "fields": self.fields,
+        }
+
+    def as_payload(self) -> dict:
+        """
+        The request as a JSON payload, rebuilt from the columns for streamed requests.
+        """
+        if self.payload is None:
+            self.payload = {
+                **self.sort_options(),
+                "itineraries": [
+                    {
+                        "id": itinerary_id,
+                        "duration_minutes": duration,
+                        "price": {"amount": amount, "currency": currency},
+                    }
+                    for itinerary_id, duration, amount, currency in self.columns.rows(slice(None))
+                ],
+            }
+        return self.payload
+
+    def dumps(self) -> bytes:
+        """
+        The request as stored to sort it later, see `parse_stored_request`: its options as JSON on the first line,
+        then its columns encoded by `codec.encode_columns`, so no dict is built per itinerary.
+        """
+        return orjson.dumps(self.sort_options()) + b"\n" + codec.encode_columns(self.columns)
+
+
+class _SlowPath(Exception):
+    """
+    The payload needs full model validation, either to coerce lax input or to report errors.
+    """
+
+
+def _types(column: list) -> set:
+    return set(map(type, column))
+
+
+def _itinerary_columns(itineraries: list, rate_table: RateTable) -> ItineraryColumns:
+    try:
+        ids = [itinerary["id"] for itinerary in itineraries]
+        durations = [itinerary["duration_minutes"] for itinerary in itineraries]
+        prices = [itinerary["price"] for itinerary in itineraries]
+        amounts = [price["amount"] for price in prices]
+        currencies = [price["currency"] for price in prices]
+    except (KeyError, TypeError):
+        raise _SlowPath
+
+    # Type checks run once per column at C speed instead of once per field in a model. Amounts given as strings
+    # are left to the model, float() accepts forms it rejects, e.g. Arabic digits
+    if not (
+        _types(ids) <= {str}
+        and _types(durations) <= {int}
+        and _types(amounts) <= {int, float}
+        and _types(currencies) <= {str}
+    ):
+        raise _SlowPath
+    if ids and max(map(len, ids)) > MAX_ID_LENGTH:
+        raise _SlowPath
+
+    try:
+        durations = np.array(durations, dtype=np.int64)
+        amounts = np.array(amounts, dtype=np.float64)
+        currencies = rate_table.currency_codes(currencies)
+    except (ValueError, OverflowError):
+        raise _SlowPath
+    if (durations < 0).any():
+        raise _SlowPath
+
+    return ItineraryColumns(
+        ids=np.array(ids, dtype=str),
+        durations=durations,
+        amounts=amounts,
+        currencies=currencies,
+        rate_table=rate_table,
+    )
+
+
+def _parse_columns(payload) -> ColumnarSortRequest:
+    if not isinstance(payload, dict) or not isinstance(payload.get("itineraries"), list):
+        raise _SlowPath
+    try:
+        options = SortOptions.model_validate({key: value for key, value in payload.items() if key != "itineraries"})
+    except ValidationError:
+        raise _SlowPath
+
+    return ColumnarSortRequest.from_options(
+        options, _itinerary_columns(payload["itineraries"], get_rate_table()), payload
+    )
+
+
+def _json_error(e: json.JSONDecodeError, loc: tuple) -> dict:
+    return {
+        "type": "json_invalid",
+        "loc": loc,
+        "msg": "JSON decode error",
+        "input": {},
+        "ctx": {"error": e.msg},
+    }
+
+
+def _request_validation_error(errors: list[dict], body=None) -> Exception:
+    # Raised the way FastAPI reports invalid requests, it is only imported once a request is invalid
+    # so workers sorting valid requests don't load it
+    from fastapi.exceptions import RequestValidationError
+
+    return RequestValidationError(errors, body=body)
+
+
+def _validation_errors(e: ValidationError, loc: tuple) -> list[dict]:
+    return [{**error, "loc": (*loc, *error["loc"])} for error in e.errors(include_url=False)]
+
+
+def _load_json(body: bytes | str | dict):
+    if isinstance(body, dict):
+        return body
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        pass
+    # Decode invalid bodies again with the json module, so errors read the same as FastAPI's
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError as e:
+        raise _request_validation_error([_json_error(e, ("body", e.pos))], e.doc) from e
+
+
+def parse_sort_request(body: bytes | str | dict) -> ColumnarSortRequest:
+    """
+    Parse and validate a sort request straight into columns.
+    Payloads the column-wise checks don't accept are validated with `SortRequest`, so lax input
+    is coerced the same way and bad input raises the same 422 errors as a `SortRequest` body.
+    """
+    payload = _load_json(body)
+    try:
+        return _parse_columns(payload)
+    except _SlowPath:
+        pass
+
+    try:
+        request = SortRequest.model_validate(payload)
+    except ValidationError as e:
+        raise _request_validation_error(_validation_errors(e, ("body",)), payload) from e
+    return ColumnarSortRequest.from_model(request, payload)
+
+
+def _job_requests(
+    options: list[SortOptions],
+    columns: ItineraryColumns,
+    itineraries: list,
+) -> list[ColumnarSortRequest]:
+    # Every sorting type of a job shares its columns, filtered once, so prices are converted once for all of them
+    if options[0].filters:
+        columns = filter_columns(columns, **options[0].filters.model_dump(exclude_none=True))
+    columns = canonical(columns)
+    return [
+        ColumnarSortRequest.from_options(
+            job_options,
+            columns,
+            {**job_options.model_dump(exclude_none=True), "itineraries": itineraries},
+            filtered=True,
+        )
+        for job_options in options
+    ]
+
+
+def _parse_batch_columns(payload) -> list[list[ColumnarSortRequest]]:
+    if not isinstance(payload, dict) or not isinstance(payload.get("jobs"), list) or not payload["jobs"]:
+        raise _SlowPath
+    rate_table = get_rate_table()
+    jobs = []
+    for job in payload["jobs"]:
+        if (
+            not isinstance(job, dict)
+            or not isinstance(job.get("itineraries"), list)
+            or not isinstance(job.get("sorting_types"), list)
+            or not job["sorting_types"]
+        ):
+            raise _SlowPath
+        weights = {key: value for key, value in job.items() if key not in ("sorting_types", "itineraries")}
+        try:
+            options = [
+                SortOptions.model_validate({**weights, "sorting_type": sorting_type})
+                for sorting_type in job["sorting_types"]
+            ]
+        except ValidationError:
+            raise _SlowPath
+        jobs.append(_job_requests(options, _itinerary_columns(job["itineraries"], rate_table), job["itineraries"]))
+    return jobs
+
+
+def parse_batch_sort_request(body: bytes | str | dict) -> list[list[ColumnarSortRequest]]:
+    """
+    Parse and validate a batch of sort jobs, returns one request per sorting type of each job.
+    Each job is parsed and converted to columns once, the requests of a job share them.
+    Like `parse_sort_request`, payloads the fast path doesn't accept are validated with `BatchSortRequest`.
+    """
+    payload = _load_json(body)
+    try:
+        return _parse_batch_columns(payload)
+    except _SlowPath:
+        pass
+
+    try:
+        request = BatchSortRequest.model_validate(payload)
+    except ValidationError as e:
+        raise _request_validation_error(_validation_errors(e, ("body",)), payload) from e
+    rate_table = get_rate_table()
+    return [
+        _job_requests(
+            [
+                SortOptions(sorting_type=sorting_type, **job.model_dump(exclude={"sorting_types", "itineraries"}))
+                for sorting_type in job.sorting_types
+            ],
+            ItineraryColumns.from_itineraries(job.itineraries, rate_table),
+            job_payload["itineraries"],
+        )
+        for job, job_payload in zip(request.jobs, payload["jobs"])
+    ]
+
+
+def _parse_ndjson_batch(lines: list[bytes], first_index: int, rate_table: RateTable) -> ItineraryColumns:
+    itineraries = []
+    for index, line in enumerate(lines, first_index):
+        try:
+            itineraries.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            try:
+                json.loads(line)
+            except json.JSONDecodeError as e:
+                raise _request_validation_error([_json_error(e, ("body", index, e.pos))]) from e
+
+    try:
+        return _itinerary_columns(itineraries, rate_table)
+    except _SlowPath:
+        pass
+
+    models, errors = [], []
+    for index, itinerary in enumerate(itineraries, first_index):
+        try:
+            models.append(Itinerary.model_validate(itinerary))
+        except ValidationError as e:
+            errors.extend(_validation_errors(e, ("body", index)))
+    if errors:
+        raise _request_validation_error(errors)
+    return ItineraryColumns.from_itineraries(models, rate_table)
+
+
+def parse_serialized_itineraries(items: list[bytes], rate_table: RateTable | None = None) -> ItineraryColumns:
+    """
+    Parse itineraries serialized by `ItineraryColumns.serialize` back into columns, in the same order.
+    """
+    rate_table = rate_table or get_rate_table()
+    itineraries = [orjson.loads(item) for item in items]
+    try:
+        return _itinerary_columns(itineraries, rate_table)
+    except _SlowPath:
+        return ItineraryColumns.from_itineraries(
+            [Itinerary.model_validate(itinerary) for itinerary in itineraries], rate_table
+        )
+
+
+def parse_stored_request(data: bytes | dict) -> ColumnarSortRequest:
+    """
+    Parse a request stored by `ColumnarSortRequest.dumps`. JSON payloads, e.g. sent with a task or stored
+    before requests were stored as columns, are parsed by `parse_sort_request`, they never hold a raw newline.
+    """
+    if isinstance(data, bytes):
+        options, newline, columns = data.partition(b"\n")
+        if newline:
+            return ColumnarSortRequest.from_options(
+                SortOptions.model_validate_json(options), codec.decode_columns(columns), None, filtered=True
+            )
+    return parse_sort_request(data)
+
+
+async def parse_ndjson_sort_request(
+    chunks: AsyncIterator[bytes],
+    options: dict,
+    batch_size: int = NDJSON_BATCH_SIZE,
+) -> ColumnarSortRequest:
+    """
+    Parse a stream of NDJSON itineraries, one per line, with the sorting `options` given separately.
+    Lines are parsed and validated in batches of `batch_size` into columns as they arrive, in the executor,
+    so at most one batch is held as Python objects. Each line's id is held to MAX_ID_LENGTH, which bounds the width
+    of the joined id column. Errors are located by the line's position among the itineraries.
+    """
+    try:
+        sort_options = SortOptions.model_validate(options)
+    except ValidationError as e:
+        raise _request_validation_error(_validation_errors(e, ("query",))) from e
+
+    rate_table = get_rate_table()
+    parts, lines, parsed = [], [], 0
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *complete, buffer = buffer.split(b"\n")
+        lines.extend(line for line in complete if line.strip())
+        while len(lines) >= batch_size:
+            batch = lines[:batch_size]
+            parts.append(await executor.run(_parse_ndjson_batch, batch, parsed, rate_table, size=len(batch)))
+            lines = lines[batch_size:]
+            parsed += batch_size
+    if buffer.strip():
+        lines.append(buffer)
+    if lines:
+        parts.append(await executor.run(_parse_ndjson_batch, lines, parsed, rate_table, size=len(lines)))
+
+    columns = ItineraryColumns.concatenate(parts, rate_table)
+    # Filtering and putting the columns in canonical order run off the event loop too
+    return await executor.run(ColumnarSortRequest.from_options, sort_options, columns, None, size=len(columns))
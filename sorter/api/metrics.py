@@ -0,0 +1,159 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+
+# Payload sizes are reported in buckets so the number of label values stays small
+SIZE_BUCKETS = ((1_000, "1k"), (10_000, "10k"), (100_000, "100k"), (1_000_000, "1M"))
+
+STAGE_DURATION = Histogram(
+    "sorter_stage_duration_seconds",
+    "Time spent in each stage of handling a sort request",
+    ["stage", "sorting_type", "size_bucket"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUESTS = Counter(
+    "sorter_requests_total",
+    "Sort requests handled by the API or the worker",
+    ["sorting_type", "size_bucket"],
+)
+
+ADMISSIONS = Counter(
+    "sorter_admission_total",
+    "Requests scheduled or turned away by admission control instead of being sorted synchronously",
+    ["decision"],
+)
+
+
+def size_bucket(size: int) -> str:
+    for limit, label in SIZE_BUCKETS:
+        if size <= limit:
+            return label
+    return "inf"
+
+
+class StageTimings:
+    """
+    Durations (in seconds) of the stages run while handling one request.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.sorting_type = "unknown"
+        self.size = 0
+
+    def record(self, name: str, duration: float):
+        self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={duration * 1000:.3f}" for name, duration in self.stages.items())
+
+
+_timings: ContextVar[StageTimings | None] = ContextVar("stage_timings", default=None)
+
+
+def current() -> StageTimings | None:
+    return _timings.get()
+
+
+@contextmanager
+def collect():
+    """
+    Collect the stages run in this context into a new `StageTimings`.
+    """
+    timings = StageTimings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a stage of the current request, does nothing outside of `collect`.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.record(name, time.perf_counter() - start)
+
+
+def describe(sorting_type: str, size: int):
+    """
+    Set the labels the stages of the current request are reported with.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.sorting_type = sorting_type
+        timings.size = size
+
+
+def timed_call(func, *args):
+    """
+    Call `func` and return its result with the stages it ran, used where the context isn't
+    carried over, e.g. in executor threads and processes.
+    """
+    with collect() as timings:
+        result = func(*args)
+    return result, timings.stages
+
+
+def observe(timings: StageTimings):
+    if not timings.stages:
+        return
+    labels = (timings.sorting_type, size_bucket(timings.size))
+    REQUESTS.labels(*labels).inc()
+    for name, duration in timings.stages.items():
+        STAGE_DURATION.labels(name, *labels).observe(duration)
+
+
+def render() -> tuple[bytes, str]:
+    """
+    Render the metrics in the Prometheus text format, merged across processes
+    when PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware collecting the stage timings of each HTTP request, they are observed once the
+    response is sent and, with `server_timing`, reported in a Server-Timing header.
+    """
+
+    def __init__(self, app, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with collect() as timings:
+            async def send_with_timings(message):
+                if self.server_timing and message["type"] == "http.response.start" and timings.stages:
+                    headers = [*message.get("headers", []), (b"server-timing", timings.server_timing().encode())]
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timings)
+            finally:
+                observe(timings)
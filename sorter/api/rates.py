@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from sorter.config import RATES_FILE, RATES_RELOAD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+BASE_CURRENCY = "EUR"
+
+
+class RateTable:
+    """
+    Exchange rates of every known currency to EUR, kept in a NumPy array so a whole
+    price column can be converted in one step.
+    """
+
+    def __init__(self, rates: dict[str, float], source_mtime: float | None = None):
+        self.currencies = tuple(sorted(rates))
+        self.index = {currency: position for position, currency in enumerate(self.currencies)}
+        self.rates = np.array([rates[currency] for currency in self.currencies], dtype=np.float64)
+        self.source_mtime = source_mtime
+
+    @classmethod
+    def from_file(cls, currency_file: str | None = None) -> "RateTable":
+        """
+        Build a rate table from an ECB rates file using the latest known rate of each currency.
+        """
+        from currency_converter import CurrencyConverter, CURRENCY_FILE
+
+        currency_file = currency_file or CURRENCY_FILE
+        converter = CurrencyConverter(currency_file)
+        rates = {currency: converter.convert(1, currency, BASE_CURRENCY) for currency in converter.currencies}
+        return cls(rates, source_mtime=os.stat(currency_file).st_mtime)
+
+    def currency_index(self, currency: str) -> int:
+        try:
+            return self.index[currency]
+        except KeyError:
+            raise ValueError(f"{currency} is not a supported currency") from None
+
+    def currency_codes(self, currencies) -> np.ndarray:
+        """
+        Map an array of currency strings to their positions in the table.
+        """
+        unique, inverse = np.unique(np.asarray(currencies, dtype=str), return_inverse=True)
+        positions = np.array([self.currency_index(currency) for currency in unique], dtype=np.int16)
+        return positions[inverse.reshape(-1)]
+
+    def to_eur(self, amounts, currencies) -> np.ndarray:
+        """
+        Convert a column of amounts to EUR, `currencies` holds either currency strings or their positions.
+        """
+        currencies = np.asarray(currencies)
+        if not np.issubdtype(currencies.dtype, np.integer):
+            currencies = self.currency_codes(currencies)
+        return np.asarray(amounts, dtype=np.float64) * self.rates[currencies]
+
+    def convert(self, amount: float | int, from_currency: str, to_currency: str = BASE_CURRENCY) -> float:
+        from_rate = self.rates[self.currency_index(from_currency)]
+        to_rate = self.rates[self.currency_index(to_currency)]
+        return float(amount * from_rate / to_rate)
+
+
+_rate_table: RateTable | None = None
+_last_checked = 0.0
+_lock = threading.Lock()
+
+
+def load_rate_table(currency_file: str | None = RATES_FILE) -> RateTable:
+    """
+    (Re)load the process-wide rate table, called on startup.
+    """
+    global _rate_table, _last_checked
+    with _lock:
+        _rate_table = RateTable.from_file(currency_file)
+        _last_checked = time.monotonic()
+        logger.info(f"Loaded exchange rates for {len(_rate_table.currencies)} currencies")
+    return _rate_table
+
+
+def _rates_file_changed(rate_table: RateTable, currency_file: str | None) -> bool:
+    from currency_converter import CURRENCY_FILE
+
+    try:
+        return os.stat(currency_file or CURRENCY_FILE).st_mtime != rate_table.source_mtime
+    except OSError as e:
+        logger.warning(f"Could not check rates file for changes, keeping current rates: {e}")
+        return False
+
+
+def get_rate_table(currency_file: str | None = RATES_FILE) -> RateTable:
+    """
+    Return the process-wide rate table, loading it lazily and reloading it when the rate file changes.
+    """
+    global _last_checked
+    rate_table = _rate_table
+    if rate_table is None:
+        return load_rate_table(currency_file)
+
+    now = time.monotonic()
+    if now - _last_checked >= RATES_RELOAD_INTERVAL:
+        _last_checked = now
+        if _rates_file_changed(rate_table, currency_file):
+            try:
+                return load_rate_table(currency_file)
+            except Exception as e:
+                logger.error(f"Error while reloading exchange rates, keeping current rates: {e}")
+
+    return rate_table
@@ -0,0 +1,342 @@
+import json
+import uuid
+
+import orjson
+import redis
+import redis.asyncio
+
+from sorter.api import codec
+from sorter.api.engine import SortedItineraries
+from sorter.api.metrics import stage
+from sorter.config import CACHE_ENCODING, CACHE_TTL, REDIS_MAX_CONNECTIONS, REDIS_URL, TASK_QUEUE
+
+# Shared clients, the async one is used by the API and the sync one by the Dramatiq worker.
+# Both are created on first use, the API creates and closes its client in the app lifespan.
+redis_client: redis.asyncio.Redis | None = None
+sync_redis_client: redis.Redis | None = None
+
+# Only one process sorts a given request at a time, others wait up to this long for its result
+LOCK_TTL = 60
+# Items are pushed to Redis in chunks so huge results don't build one giant command
+PUSH_CHUNK_SIZE = 10_000
+# How results are stored: "json" keeps one serialized item per itinerary, "columnar" keeps compressed
+# chunks of columns (see `codec`), both are read back as serialized items
+ENCODINGS = ("json", "columnar")
+
+
+def connect(url: str = REDIS_URL, max_connections: int = REDIS_MAX_CONNECTIONS) -> redis.asyncio.Redis:
+    global redis_client
+    redis_client = redis.asyncio.Redis.from_url(url, max_connections=max_connections)
+    return redis_client
+
+
+async def close():
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+
+
+def get_redis() -> redis.asyncio.Redis:
+    if redis_client is None:
+        return connect()
+    return redis_client
+
+
+def get_sync_redis() -> redis.Redis:
+    global sync_redis_client
+    if sync_redis_client is None:
+        sync_redis_client = redis.Redis.from_url(REDIS_URL)
+    return sync_redis_client
+
+
+def result_key(cache_key: str) -> str:
+    return f"sorted:{cache_key}"
+
+
+def chunks_key(cache_key: str) -> str:
+    return f"sorted:{cache_key}:chunks"
+
+
+def meta_key(cache_key: str) -> str:
+    return f"sorted:{cache_key}:meta"
+
+
+def request_key(cache_key: str) -> str:
+    return f"sorted:{cache_key}:request"
+
+
+def status_key(cache_key: str) -> str:
+    return f"sorted:{cache_key}:status"
+
+
+def lock_key(cache_key: str) -> str:
+    return f"sorted:{cache_key}:lock"
+
+
+def queue_key(queue_name: str) -> str:
+    # The Dramatiq Redis broker keeps the ids of the messages waiting in a queue in this list
+    return f"dramatiq:{queue_name}"
+
+
+# Commands are queued on a pipeline (or run directly on a client) of either client type,
+# so the API and the worker write the same format
+
+
+def encode_sorted_itineraries(
+    sorted_itineraries: SortedItineraries | list[bytes],
+    total: int,
+    options: dict | None = None,
+    encoding: str | None = None,
+) -> tuple[list[bytes], dict]:
+    """
+    Build the items of a stored result and its meta, either one item serialized to JSON per itinerary or,
+    with the "columnar" `encoding`, compressed chunks of columns. The sorting `options` are kept in the meta
+    so the result can be updated later. This is the CPU-bound part of storing a result, see `queue_encoded_itineraries`.
+    """
+    encoding = encoding or CACHE_ENCODING
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Invalid cache encoding {encoding!r}, expected one of {ENCODINGS}")
+
+    meta = {"total": total, "sorted": len(sorted_itineraries)}
+    if options:
+        meta["options"] = options
+    if encoding == "columnar":
+        # Chunks hold every field, a projection is applied when they are decoded
+        chunk_size = codec.CHUNK_SIZE
+        items = codec.encode(sorted_itineraries, chunk_size)
+        meta.update(encoding=encoding, chunk_size=chunk_size)
+        if isinstance(sorted_itineraries, SortedItineraries) and sorted_itineraries.fields:
+            meta["fields"] = sorted_itineraries.fields
+    else:
+        # Items that are already serialized, e.g. kept from another stored result, are stored as they are
+        items = sorted_itineraries
+        if isinstance(items, SortedItineraries):
+            items = items.serialize()
+    return items, meta
+
+
+def queue_encoded_itineraries(
+    pipeline,
+    cache_key: str,
+    items: list[bytes],
+    meta: dict,
+    request: bytes | dict | None = None,
+):
+    """
+    Queue storing items built by `encode_sorted_itineraries` as a Redis list so pages can be read with LRANGE.
+    The `request` (see `ColumnarSortRequest.dumps`) is kept when only a window of the itineraries was sorted,
+    under its own key so reading a page doesn't load it.
+    """
+    if meta.get("encoding") == "columnar":
+        key, stale_key = chunks_key(cache_key), result_key(cache_key)
+    else:
+        key, stale_key = result_key(cache_key), chunks_key(cache_key)
+
+    pipeline.delete(key, stale_key)
+    for start in range(0, len(items), PUSH_CHUNK_SIZE):
+        pipeline.rpush(key, *items[start:start + PUSH_CHUNK_SIZE])
+    pipeline.expire(key, CACHE_TTL)
+    pipeline.setex(meta_key(cache_key), CACHE_TTL, json.dumps(meta))
+    if request:
+        queue_request(pipeline, cache_key, request)
+    else:
+        pipeline.delete(request_key(cache_key))
+
+
+def queue_sorted_itineraries(
+    pipeline,
+    cache_key: str,
+    sorted_itineraries: SortedItineraries | list[bytes],
+    total: int,
+    request: bytes | dict | None = None,
+    options: dict | None = None,
+    encoding: str | None = None,
+) -> dict:
+    """
+    Encode and queue storing sorted itineraries, see `encode_sorted_itineraries` and `queue_encoded_itineraries`.
+    """
+    items, meta = encode_sorted_itineraries(sorted_itineraries, total, options, encoding)
+    queue_encoded_itineraries(pipeline, cache_key, items, meta, request)
+    return meta
+
+
+def queue_request(pipeline, cache_key: str, request: bytes | dict):
+    # JSON payloads are still accepted, they are read back the same way
+    pipeline.setex(request_key(cache_key), CACHE_TTL, request if isinstance(request, bytes) else orjson.dumps(request))
+
+
+def queue_status(pipeline, cache_key: str, status: str, detail: str | None = None):
+    pipeline.setex(status_key(cache_key), CACHE_TTL, json.dumps({"status": status, "detail": detail}))
+
+
+async def store_sorted_itineraries(
+    cache_key: str,
+    sorted_itineraries: SortedItineraries | list[bytes],
+    total: int,
+    request: bytes | dict | None = None,
+    options: dict | None = None,
+    encoding: str | None = None,
+) -> dict:
+    items, meta = encode_sorted_itineraries(sorted_itineraries, total, options, encoding)
+    return await store_encoded_itineraries(cache_key, items, meta, request)
+
+
+async def store_encoded_itineraries(
+    cache_key: str,
+    items: list[bytes],
+    meta: dict,
+    request: bytes | dict | None = None,
+) -> dict:
+    """
+    Store items built by `encode_sorted_itineraries`, e.g. in the executor, with one pipelined round trip.
+    """
+    with stage("cache_write"):
+        async with get_redis().pipeline(transaction=True) as pipeline:
+            queue_encoded_itineraries(pipeline, cache_key, items, meta, request)
+            await pipeline.execute()
+    return meta
+
+
+async def store_request(cache_key: str, request: bytes):
+    """
+    Store a scheduled request (see `ColumnarSortRequest.dumps`), the task is sent with the key instead of the payload.
+    """
+    async with get_redis().pipeline(transaction=False) as pipeline:
+        queue_request(pipeline, cache_key, request)
+        await pipeline.execute()
+
+
+async def has_sorted_itineraries(cache_key: str) -> bool:
+    return bool(await get_redis().exists(meta_key(cache_key)))
+
+
+async def load_meta(cache_key: str) -> dict | None:
+    meta = await get_redis().get(meta_key(cache_key))
+    if not meta:
+        return None
+    return json.loads(meta)
+
+
+async def load_request(cache_key: str) -> bytes | None:
+    """
+    Load a stored request still encoded, it is parsed by `parse_stored_request`.
+    """
+    return await get_redis().get(request_key(cache_key)) or None
+
+
+def load_requests(redis_client: redis.Redis, cache_keys: list[str]) -> list[bytes | None]:
+    """
+    Load the stored payloads of several requests with the sync client in one round trip, still encoded.
+    """
+    if not cache_keys:
+        return []
+    return redis_client.mget([request_key(cache_key) for cache_key in cache_keys])
+
+
+async def load_page(
+    cache_key: str,
+    start: int,
+    end: int,
+    refresh_ttl: bool = False,
+) -> tuple[dict | None, list[bytes]]:
+    """
+    Load the meta data and the serialized itineraries in [start, end) in one round trip,
+    with `refresh_ttl` the result is kept for another CACHE_TTL.
+    """
+    with stage("cache_read"):
+        # The range is read in both encodings, only the one the result was stored in exists
+        first_chunk = start // codec.CHUNK_SIZE
+        async with get_redis().pipeline(transaction=False) as pipeline:
+            pipeline.get(meta_key(cache_key))
+            pipeline.lrange(result_key(cache_key), start, end - 1)
+            pipeline.lrange(chunks_key(cache_key), first_chunk, (end - 1) // codec.CHUNK_SIZE)
+            if refresh_ttl:
+                for key in (
+                    meta_key(cache_key),
+                    result_key(cache_key),
+                    chunks_key(cache_key),
+                    request_key(cache_key),
+                    status_key(cache_key),
+                ):
+                    pipeline.expire(key, CACHE_TTL)
+            meta, items, chunks, *_ = await pipeline.execute()
+        if not meta:
+            return None, []
+        meta = json.loads(meta)
+        if meta.get("encoding") == "columnar":
+            chunk_size = meta["chunk_size"]
+            if chunk_size != codec.CHUNK_SIZE:
+                # Stored with another chunk size
+                first_chunk = start // chunk_size
+                chunks = await get_redis().lrange(chunks_key(cache_key), first_chunk, (end - 1) // chunk_size)
+            items = codec.decode(
+                chunks, start - first_chunk * chunk_size, end - first_chunk * chunk_size, chunk_size, meta.get("fields")
+            )
+    return meta, items
+
+
+async def set_status(cache_key: str, status: str, detail: str | None = None):
+    async with get_redis().pipeline(transaction=False) as pipeline:
+        queue_status(pipeline, cache_key, status, detail)
+        await pipeline.execute()
+
+
+async def load_status(cache_key: str) -> dict | None:
+    status = await get_redis().get(status_key(cache_key))
+    if not status:
+        return None
+    return json.loads(status)
+
+
+async def queue_depth(queue_name: str = TASK_QUEUE) -> int:
+    """
+    Number of scheduled tasks waiting for a worker.
+    """
+    return await get_redis().llen(queue_key(queue_name))
+
+
+async def mark_pending(cache_key: str) -> bool:
+    """
+    Mark a task as pending, returns False when it is already pending or running.
+    """
+    pending = json.dumps({"status": "pending", "detail": None})
+    if await get_redis().set(status_key(cache_key), pending, nx=True, ex=CACHE_TTL):
+        return True
+    # A failed task, or a done one whose result expired, can be scheduled again
+    status = await load_status(cache_key)
+    if status and status["status"] in ("failed", "done"):
+        await set_status(cache_key, "pending")
+        return True
+    return False
+
+
+async def acquire_lock(cache_key: str) -> str | None:
+    """
+    Take the lock on sorting a request, returns the token to release it with, or None if another process holds it.
+    """
+    token = uuid.uuid4().hex
+    if await get_redis().set(lock_key(cache_key), token, nx=True, ex=LOCK_TTL):
+        return token
+    return None
+
+
+async def is_locked(cache_key: str) -> bool:
+    return bool(await get_redis().exists(lock_key(cache_key)))
+
+
+async def release_lock(cache_key: str, token: str):
+    """
+    Release a lock taken with `token`. A lock that expired and was taken by another process is left alone.
+    """
+    key = lock_key(cache_key)
+    async with get_redis().pipeline() as pipeline:
+        try:
+            await pipeline.watch(key)
+            if await pipeline.get(key) == token.encode():
+                pipeline.multi()
+                pipeline.delete(key)
+                await pipeline.execute()
+        except redis.WatchError:
+            # The lock changed hands while releasing it, it isn't ours anymore
+            pass
@@ -1,18 +1,20 @@
 import logging
-import asyncio
-from currency_converter import CurrencyConverter
+
+import numpy as np
+
+from sorter.api.rates import get_rate_table, RateTable
 
 logger = logging.getLogger(__name__)
 
 
 async def convert_currency(from_currency:str, amount_to_convert:float | int, to_currency:str | None = "EUR") -> float:
     # TODO: Use better solution for exchange rates like forex-python?
-    # Using currency_converter for now because of the simplicity of task and having offline currency rates
+    # Using currency_converter rates for now because of the simplicity of task and having offline currency rates
     """
     Convert an amount from one currency to another.
     """
     try:
-        result = CurrencyConverter().convert(amount_to_convert, from_currency, to_currency)
+        result = get_rate_table().convert(amount_to_convert, from_currency, to_currency)
     except Exception as e:
         logger.error(f"Error while converting {amount_to_convert=} {from_currency=} {to_currency=}: {e}")
         raise e
@@ -20,35 +22,54 @@ async def convert_currency(from_currency:str, amount_to_convert:float | int, to_
     return result
 
 
-async def convert_prices_async(itineraries_df):
+def convert_prices(amounts, currencies, rate_table: RateTable | None = None) -> np.ndarray:
+    """
+    Convert a column of prices to a common currency (EUR) in one vectorized step.
+    """
+    try:
+        return (rate_table or get_rate_table()).to_eur(amounts, currencies)
+    except Exception as e:
+        logger.error(f"Error while converting prices to EUR: {e}")
+        raise e
+
+
+def normalize(values: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
     """
-    Convert all prices in a DataFrame to a common currency (EUR) asynchronously.
+    Normalize a column to a range between 0 and 1 as float32, written to `out` when given.
+    A column whose values are all equal has no range and normalizes to zeros.
     """
-    tasks = [
-        convert_currency(row["price_currency"], row["price_amount"])
-        for _, row in itineraries_df.iterrows()
-    ]
-    itineraries_df["price_eur"] = await asyncio.gather(*tasks)
+    if out is None:
+        out = np.empty(len(values), dtype=np.float32)
+    if not len(values):
+        return out
+    min_value = values.min()
+    value_range = values.max() - min_value
+    if not value_range > 0:
+        out.fill(0)
+        return out
+    return np.divide(values - min_value, value_range, out=out, casting="unsafe")
 
 
-def normalize_column(dataframe, column_name):
+def weighted_scores(
+    normalized_prices: np.ndarray,
+    normalized_durations: np.ndarray,
+    price_weight=0.5,
+    duration_weight=0.5,
+    out: np.ndarray | None = None,
+    scratch: np.ndarray | None = None,
+) -> np.ndarray:
     """
-    Normalize a column in a DataFrame to a range between 0 and 1 for faster sorting.
+    Score each itinerary from its normalized price and duration, written to `out` when given, with `scratch`
+    no temporary array is allocated. The normalized columns don't depend on the weights, so they can be
+    reused to score with others.
     """
-    min_value = dataframe[column_name].min()
-    max_value = dataframe[column_name].max()
-    dataframe[f"normalized_{column_name}"] = (dataframe[column_name] - min_value) / (max_value - min_value)
-    return dataframe
+    out = np.multiply(normalized_prices, np.float32(price_weight), out=out)
+    out += np.multiply(normalized_durations, np.float32(duration_weight), out=scratch)
+    return out
 
 
-async def add_score_to_itineraries(itineraries_df, price_weight=0.5, duration_weight=0.5):
+def score_itineraries(price_eur: np.ndarray, durations: np.ndarray, price_weight=0.5, duration_weight=0.5) -> np.ndarray:
     """
-    Add a score to each itinerary based on the price and duration weights.
+    Score each itinerary based on the price and duration weights.
     """
-    await convert_prices_async(itineraries_df)
-    itineraries_df = normalize_column(itineraries_df, "price_eur")
-    itineraries_df = normalize_column(itineraries_df, "duration_minutes")
-    itineraries_df["score"] = (price_weight * itineraries_df["normalized_price_eur"]) + (
-            duration_weight * itineraries_df["normalized_duration_minutes"]
-    )
-    return itineraries_df
+    return weighted_scores(normalize(price_eur), normalize(durations), price_weight, duration_weight)
@@ -1,124 +1,219 @@
-import pandas as pd
 import numpy as np
 
-from sorter.schemas.itinerirary_schemas import SortRequest
-from sorter.api.utils import convert_prices_async, add_score_to_itineraries
-
-
-async def sort_cheapest(request: SortRequest):
-    itineraries = request.itineraries
-    sorting_type = request.sorting_type
-
-    data = [
-        {
-            "id": itinerary.id,
-            "duration_minutes": itinerary.duration_minutes,
-            "price_amount": float(itinerary.price.amount),
-            "price_currency": itinerary.price.currency
-        }
-        for itinerary in itineraries
-    ]
-    itineraries_df = pd.DataFrame(data)
-
-    await convert_prices_async(itineraries_df)
-
-    sorted_indices = np.argsort(itineraries_df["price_eur"].values)
-    sorted_df = itineraries_df.iloc[sorted_indices].reset_index(drop=True)
-    sorted_itineraries = sorted_df.drop(columns="price_eur").to_dict(orient="records")
-
+from sorter.schemas.itinerirary_schemas import SortDelta, SortRequest
+from sorter.api import executor, storage
+from sorter.api.engine import (
+    ItineraryColumns,
+    SortedItineraries,
+    canonical,
+    filter_columns,
+    fingerprint,
+    fingerprints,
+    merge_order,
+    sort_order,
+    sort_orders,
+)
+from sorter.api.ingest import (
+    ColumnarSortRequest,
+    parse_batch_sort_request,
+    parse_serialized_itineraries,
+    parse_sort_request,
+    parse_stored_request,
+)
+from sorter.api.metrics import stage
+from sorter.api.rates import get_rate_table
+
+# Rough size of an itinerary in a JSON body, to tell how many a body holds before it is parsed
+BODY_BYTES_PER_ITINERARY = 100
+
+
+def request_columns(request: SortRequest | ColumnarSortRequest) -> ItineraryColumns:
+    if isinstance(request, ColumnarSortRequest):
+        return request.columns
+    columns = ItineraryColumns.from_itineraries(request.itineraries)
+    if request.filters:
+        columns = filter_columns(columns, **request.filters.model_dump(exclude_none=True))
+    return canonical(columns)
+
+
+def request_fingerprint(
+    request: SortRequest | ColumnarSortRequest,
+    columns: ItineraryColumns | None = None,
+) -> str:
+    if columns is None:
+        columns = request_columns(request)
+    filters = request.filters
+    if isinstance(request, SortRequest) and filters:
+        filters = filters.model_dump(exclude_none=True)
+    return fingerprint(
+        columns,
+        request.sorting_type,
+        request.price_weight,
+        request.duration_weight,
+        request.then_by,
+        request.fields,
+        filters,
+    )
+
+
+def sort_request(
+    request: SortRequest | ColumnarSortRequest,
+    limit: int | None = None,
+    columns: ItineraryColumns | None = None,
+) -> dict:
+    """
+    Sort the itineraries of a request, the sorted items are built lazily when they are read.
+    With `limit` only the first `limit` itineraries are sorted, `total` still counts all of them.
+    """
+    if columns is None:
+        columns = request_columns(request)
+    order = sort_order(
+        columns,
+        request.sorting_type,
+        request.price_weight,
+        request.duration_weight,
+        limit=limit,
+        then_by=request.then_by,
+    )
+
+    return sort_response(request, columns, order)
+
+
+async def sort_request_offloaded(
+    request: SortRequest | ColumnarSortRequest,
+    limit: int | None = None,
+    columns: ItineraryColumns | None = None,
+) -> dict:
+    """
+    Same as `sort_request`, but the sort runs in the configured executor so it doesn't block the event loop.
+    """
+    if columns is None:
+        columns = request_columns(request)
+    order = await executor.run(
+        sort_order,
+        columns,
+        request.sorting_type,
+        request.price_weight,
+        request.duration_weight,
+        limit,
+        request.then_by,
+        size=len(columns),
+    )
+
+    return sort_response(request, columns, order)
+
+
+def sort_response(request: SortRequest | ColumnarSortRequest, columns: ItineraryColumns, order) -> dict:
     response = {
-        "sorting_type": sorting_type,
-        "sorted_itineraries": [
-            {
-                "id": item["id"],
-                "duration_minutes": item["duration_minutes"],
-                "price": {
-                    "amount": str(item["price_amount"]),
-                    "currency": item["price_currency"]
-                }
-            }
-            for item in sorted_itineraries
-        ]
+        "sorting_type": request.sorting_type,
+        "total": len(columns),
+        "sorted_itineraries": SortedItineraries(columns, order, request.fields),
     }
 
     return response
 
 
-async def sort_fastest(request: SortRequest):
-    itineraries = request.itineraries
-    sorting_type = request.sorting_type
-
-    data = [
-        {
-            "id": itinerary.id,
-            "duration_minutes": itinerary.duration_minutes,
-            "price_amount": float(itinerary.price.amount),
-            "price_currency": itinerary.price.currency
-        }
-        for itinerary in itineraries
-    ]
-    itineraries_df = pd.DataFrame(data)
-
-    sorted_indices = np.argsort(itineraries_df["duration_minutes"].values)
-    sorted_df = itineraries_df.iloc[sorted_indices].reset_index(drop=True)
-    sorted_itineraries = sorted_df.to_dict(orient="records")
-
-    response = {
-        "sorting_type": sorting_type,
-        "sorted_itineraries": [
-            {
-                "id": item["id"],
-                "duration_minutes": item["duration_minutes"],
-                "price": {
-                    "amount": str(item["price_amount"]),
-                    "currency": item["price_currency"]
-                }
-            }
-            for item in sorted_itineraries
-        ]
-    }
-
-    return response
-
-
-async def sort_best(request: SortRequest):
-    itineraries = request.itineraries
-    sorting_type = request.sorting_type
-    price_weight = request.price_weight
-    duration_weight = request.duration_weight
-
-    data = [
-        {
-            "id": itinerary.id,
-            "duration_minutes": itinerary.duration_minutes,
-            "price_amount": float(itinerary.price.amount),
-            "price_currency": itinerary.price.currency
-        }
-        for itinerary in itineraries
-    ]
-    itineraries_df = pd.DataFrame(data)
-
-    await add_score_to_itineraries(itineraries_df, price_weight, duration_weight)
-
-    sorted_indices = np.argsort(itineraries_df["score"].values)
-    sorted_df = itineraries_df.iloc[sorted_indices].reset_index(drop=True)
-    sorted_itineraries = sorted_df.drop(
-        columns=["price_eur", "normalized_price_eur", "normalized_duration_minutes", "score"]
-    ).to_dict(orient="records")
-
-    response = {
-        "sorting_type": sorting_type,
-        "sorted_itineraries": [
-            {
-                "id": item["id"],
-                "duration_minutes": item["duration_minutes"],
-                "price": {
-                    "amount": str(item["price_amount"]),
-                    "currency": item["price_currency"]
-                }
-            }
-            for item in sorted_itineraries
-        ]
-    }
-
-    return response
+# The functions below are the CPU-bound steps of the API, run with `executor.run`. Bytes and columns go in,
+# columns, orders or encoded items come out, so they can run in a process pool.
+
+
+def body_size(body: bytes) -> int:
+    return len(body) // BODY_BYTES_PER_ITINERARY
+
+
+def prepare_request(body: bytes) -> tuple[ColumnarSortRequest, str]:
+    """
+    Parse a JSON request body into columns and fingerprint it. The decoded body isn't kept,
+    so only the columns are sent back from a process pool.
+    """
+    with stage("validation"):
+        request = parse_sort_request(body)
+    request.payload = None
+    return request, request_fingerprint(request)
+
+
+def prepare_batch(body: bytes) -> tuple[list[list[ColumnarSortRequest]], list[list[str]]]:
+    """
+    Parse a batch request body and fingerprint every request of each job, see `prepare_request`.
+    """
+    with stage("validation"):
+        jobs = parse_batch_sort_request(body)
+    cache_keys = []
+    for requests in jobs:
+        for request in requests:
+            request.payload = None
+        cache_keys.append(fingerprints(
+            requests[0].columns,
+            [request.sorting_type for request in requests],
+            requests[0].price_weight,
+            requests[0].duration_weight,
+            requests[0].then_by,
+            requests[0].fields,
+            requests[0].filters,
+        ))
+    return jobs, cache_keys
+
+
+def sort_and_encode(
+    requests: list[ColumnarSortRequest],
+    limit: int | None = None,
+) -> list[tuple[list[bytes], dict, bytes | None]]:
+    """
+    Sort requests that share their columns, e.g. the sorting types of a batch job, and build the items and meta
+    to store each result (see `storage.encode_sorted_itineraries`). When only a window of `limit` itineraries
+    is sorted the stored request comes along, so the rest can be sorted later.
+    """
+    columns = requests[0].columns
+    orders = sort_orders(
+        columns,
+        [request.sorting_type for request in requests],
+        requests[0].price_weight,
+        requests[0].duration_weight,
+        limit,
+        requests[0].then_by,
+    )
+    results = []
+    for request, order in zip(requests, orders):
+        items, meta = storage.encode_sorted_itineraries(
+            SortedItineraries(columns, order, request.fields), len(columns), request.sort_options()
+        )
+        results.append((items, meta, request.dumps() if len(order) < len(columns) else None))
+    return results
+
+
+def sort_stored_request(stored_request: bytes | dict) -> tuple[list[bytes], dict]:
+    """
+    Sort all itineraries of a stored request (see `ColumnarSortRequest.dumps`) and build the items and meta to store.
+    """
+    items, meta, _ = sort_and_encode([parse_stored_request(stored_request)])[0]
+    return items, meta
+
+
+def merge_delta(sorted_itineraries: list[bytes], delta: SortDelta, options: dict) -> tuple[str, list[bytes], dict]:
+    """
+    Merge `delta` into serialized itineraries that are already sorted by `options`, returns the cache key
+    of the merged result with its items and meta. The stored items of the kept itineraries are reused as they are.
+    """
+    rate_table = get_rate_table()
+    columns = parse_serialized_itineraries(sorted_itineraries, rate_table)
+    kept = np.flatnonzero(~np.isin(columns.ids, delta.remove)) if delta.remove else np.arange(len(columns))
+    added = ItineraryColumns.from_itineraries(delta.add, rate_table)
+    if options.get("filters"):
+        added = filter_columns(added, **options["filters"])
+    merged = ItineraryColumns.concatenate([columns.take(kept), added], rate_table)
+
+    sorting_type, price_weight, duration_weight = (
+        options["sorting_type"], options["price_weight"], options["duration_weight"]
+    )
+    then_by = options.get("then_by", [])
+    order = merge_order(merged, len(kept), sorting_type, price_weight, duration_weight, then_by, merged.row_hashes)
+    merged_key = fingerprint(
+        merged, sorting_type, price_weight, duration_weight, then_by, filters=options.get("filters")
+    )
+
+    items = [sorted_itineraries[position] for position in kept.tolist()]
+    items.extend(added.serialize(np.arange(len(added))))
+    items, meta = storage.encode_sorted_itineraries(
+        [items[position] for position in order.tolist()], len(merged), options
+    )
+    return merged_key, items, meta
@@ -1,32 +1,84 @@
+import time
+
 import dramatiq
-import redis
-import json
 from dramatiq.brokers.redis import RedisBroker
-from asgiref.sync import async_to_sync
-
-from sorter.api.v1.endpoints.sort_itineriraries import sort_cheapest, sort_fastest, sort_best
-from sorter.schemas.itinerirary_schemas import SortRequest
+from dramatiq.middleware import CurrentMessage
 
-# TODO: Replace with a connection to a real database and adjust db and ttl
-redis_client = redis.Redis(host="localhost", port=6379, db=0)
-CACHE_TTL = 1800  # 30 minutes
+from sorter.api import metrics, storage
+from sorter.api.ingest import parse_stored_request
+from sorter.api.v1.endpoints.sort_itineriraries import sort_request
+from sorter.config import REDIS_URL, TASK_QUEUE
 
-broker = RedisBroker(host="localhost", port=6379)
+broker = RedisBroker(url=REDIS_URL)
+broker.add_middleware(CurrentMessage())
 dramatiq.set_broker(broker)
 
 
-@dramatiq.actor
-def sort_task(task_id: str, request_data: dict):
-    request = SortRequest(**request_data)
+class RequestExpired(Exception):
+    """
+    The payload of a task sent by reference expired before the task ran.
+    """
+
+
+@dramatiq.actor(queue_name=TASK_QUEUE)
+def sort_task(task_id: str, request_data: dict | None = None):
+    """
+    Sort a scheduled request, `request_data` is None when the payload was stored under the task id.
+    """
+    with metrics.collect() as timings:
+        message = CurrentMessage.get_current_message()
+        if message is not None:
+            # Time the task waited in the queue before a worker picked it up
+            timings.record("queue_wait", max(0.0, time.time() - message.message_timestamp / 1000))
+        try:
+            run_sort_task(task_id, request_data)
+        finally:
+            metrics.observe(timings)
+
+
+def run_sort_task(task_id: str, request_data: dict | None = None):
+    error = run_sort_tasks([(task_id, request_data)])[0]
+    if error is not None:
+        raise error
+
+
+def run_sort_tasks(tasks: list[tuple[str, dict | None]]) -> list[Exception | None]:
+    """
+    Sort several scheduled requests, returns the error each one failed with or None.
+    Requests sent by reference are loaded, and all results and statuses are written, with one round trip each.
+    They were stored as columns, see `ColumnarSortRequest.dumps`, and are parsed without building a dict per itinerary.
+    """
+    redis_client = storage.get_sync_redis()
+    referenced = [task_id for task_id, request_data in tasks if request_data is None]
+    with redis_client.pipeline(transaction=False) as pipeline:
+        for task_id, _ in tasks:
+            storage.queue_status(pipeline, task_id, "running")
+        pipeline.execute()
+    payloads = dict(zip(referenced, storage.load_requests(redis_client, referenced)))
 
-    if request.sorting_type == "cheapest":
-        response = async_to_sync(sort_cheapest)(request)
-    elif request.sorting_type == "fastest":
-        response = async_to_sync(sort_fastest)(request)
-    elif request.sorting_type == "best":
-        response = async_to_sync(sort_best)(request)
-    else:
-        raise ValueError("Invalid sorting_type")
+    errors, size = [], 0
+    with redis_client.pipeline(transaction=True) as pipeline:
+        for task_id, request_data in tasks:
+            if request_data is None:
+                request_data = payloads[task_id]
+            try:
+                if request_data is None:
+                    raise RequestExpired("The request expired before it was sorted, schedule it again")
+                with metrics.stage("validation"):
+                    request = parse_stored_request(request_data)
+                size += len(request.columns)
+                metrics.describe(request.sorting_type if len(tasks) == 1 else "batch", size)
+                response = sort_request(request)
+                storage.queue_sorted_itineraries(
+                    pipeline, task_id, response["sorted_itineraries"], response["total"], options=request.sort_options()
+                )
+            except Exception as e:
+                storage.queue_status(pipeline, task_id, "failed", detail=str(e))
+                errors.append(e)
+                continue
 
-    sorted_itineraries = response["sorted_itineraries"]
-    redis_client.setex(task_id, CACHE_TTL, json.dumps(sorted_itineraries))
+            storage.queue_status(pipeline, task_id, "done")
+            errors.append(None)
+        with metrics.stage("cache_write"):
+            pipeline.execute()
+    return errors
@@ -0,0 +1,111 @@
+"""
+Worker handling scheduled sorts in micro-batches, an alternative to the per-message `dramatiq` worker:
+
+    python -m sorter.api.v1.worker --batch-size 32 --batch-timeout 100
+
+It consumes the same queue, so both kinds of workers can run side by side. Each batch is sorted with
+plain synchronous calls and its results are written with one Redis pipeline. Dramatiq middleware
+(retries, time limits) doesn't run here, failed tasks are marked failed and dead-lettered.
+"""
+import argparse
+import inspect
+import logging
+import signal
+import threading
+import time
+
+from dramatiq.broker import Broker, Consumer, MessageProxy
+
+from sorter.api import metrics
+from sorter.api.rates import load_rate_table
+from sorter.api.v1.tasks import broker, run_sort_tasks, sort_task
+from sorter.config import TASK_BATCH_SIZE, TASK_BATCH_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+def next_batch(consumer: Consumer, batch_size: int) -> list[MessageProxy]:
+    """
+    Take up to `batch_size` messages, the consumer returns None once no message came in for its timeout.
+    """
+    messages = []
+    while len(messages) < batch_size:
+        message = next(consumer)
+        if message is None:
+            break
+        messages.append(message)
+    return messages
+
+
+def process_batch(consumer: Consumer, messages: list[MessageProxy]):
+    """
+    Run the sort tasks of a batch, acking the ones that succeeded and dead-lettering the rest.
+    """
+    tasks, task_messages = [], []
+    for message in messages:
+        if message.actor_name != sort_task.actor_name:
+            logger.warning(f"Skipping message {message.message_id} for unknown actor {message.actor_name}")
+            consumer.nack(message)
+            continue
+        arguments = inspect.signature(sort_task.fn).bind(*message.args, **message.kwargs)
+        arguments.apply_defaults()
+        tasks.append((arguments.arguments["task_id"], arguments.arguments["request_data"]))
+        task_messages.append(message)
+    if not tasks:
+        return
+
+    with metrics.collect() as timings:
+        oldest = min(message.message_timestamp for message in task_messages)
+        timings.record("queue_wait", max(0.0, time.time() - oldest / 1000))
+        try:
+            errors = run_sort_tasks(tasks)
+        finally:
+            metrics.observe(timings)
+
+    for message, (task_id, _), error in zip(task_messages, tasks, errors):
+        if error is None:
+            consumer.ack(message)
+        else:
+            logger.error(f"Sort task {task_id} failed: {error}")
+            consumer.nack(message)
+
+
+def run(
+    broker: Broker = broker,
+    batch_size: int = TASK_BATCH_SIZE,
+    batch_timeout: int = TASK_BATCH_TIMEOUT,
+    stop: threading.Event | None = None,
+):
+    """
+    Consume sort tasks in batches of up to `batch_size`, until `stop` is set.
+    """
+    stop = stop or threading.Event()
+    consumer = broker.consume(sort_task.queue_name, prefetch=batch_size, timeout=batch_timeout)
+    try:
+        while not stop.is_set():
+            messages = next_batch(consumer, batch_size)
+            if messages:
+                process_batch(consumer, messages)
+    finally:
+        consumer.close()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Run scheduled sorts in micro-batches")
+    parser.add_argument("--batch-size", type=int, default=TASK_BATCH_SIZE, help="Most tasks handled at once")
+    parser.add_argument(
+        "--batch-timeout", type=int, default=TASK_BATCH_TIMEOUT, help="Milliseconds to wait for a batch to fill"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    load_rate_table()
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    logger.info(f"Sorting tasks from {sort_task.queue_name!r} in batches of up to {args.batch_size}")
+    run(batch_size=args.batch_size, batch_timeout=args.batch_timeout, stop=stop)
+
+
+if __name__ == "__main__":
+    main()
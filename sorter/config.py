@@ -0,0 +1,61 @@
+import os
+
+# Exchange rates
+# Path to an ECB rates file (zip or csv), defaults to the file bundled with currency_converter
+RATES_FILE = os.getenv("SORTER_RATES_FILE") or None
+# How often (in seconds) the rate file is checked for changes
+RATES_RELOAD_INTERVAL = float(os.getenv("SORTER_RATES_RELOAD_INTERVAL", "60"))
+
+# Sorting
+# Synchronous requests only sort the first max(page * page_size, TOP_K_WINDOW) itineraries,
+# the rest is sorted the first time a client pages past that window
+TOP_K_WINDOW = int(os.getenv("SORTER_TOP_K_WINDOW", "100"))
+# Longest itinerary id accepted, ids are held in fixed-width columns as wide as the longest one,
+# so a single long id would inflate the memory taken by every itinerary of a request
+MAX_ID_LENGTH = int(os.getenv("SORTER_MAX_ID_LENGTH", "64"))
+
+# Redis
+# Used for the result cache and as the Dramatiq broker
+REDIS_URL = os.getenv("SORTER_REDIS_URL", "redis://localhost:6379/0")
+# Size of the connection pool shared by the API process
+REDIS_MAX_CONNECTIONS = int(os.getenv("SORTER_REDIS_MAX_CONNECTIONS", "50"))
+# Cache here is used when user navigates on a result, so we can store the result for a while
+CACHE_TTL = int(os.getenv("SORTER_CACHE_TTL", "1800"))  # 30 minutes
+# How results are cached: "json" stores each sorted itinerary serialized to JSON, "columnar" stores
+# compressed chunks of columns, several times smaller, and a page read only decodes the chunks it overlaps
+CACHE_ENCODING = os.getenv("SORTER_CACHE_ENCODING", "json")
+
+# Executor
+# Where the synchronous endpoint runs CPU-bound sorting: "inline" (on the event loop), "thread" or "process"
+SORT_EXECUTOR = os.getenv("SORTER_SORT_EXECUTOR", "thread")
+# Pool size, defaults to the number of cores
+SORT_EXECUTOR_WORKERS = int(os.getenv("SORTER_SORT_EXECUTOR_WORKERS", "0")) or os.cpu_count() or 1
+# Payloads up to this many itineraries are sorted inline, handing them to a pool costs more than it saves
+INLINE_SORT_MAX_ITINERARIES = int(os.getenv("SORTER_INLINE_SORT_MAX_ITINERARIES", "2000"))
+
+# Metrics
+# Report the stage timings of each request in a Server-Timing response header, for debugging
+SERVER_TIMING = os.getenv("SORTER_SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# Tasks
+# Dramatiq queue sort tasks are sent to
+TASK_QUEUE = os.getenv("SORTER_TASK_QUEUE", "default")
+# Scheduled requests with at least this many itineraries are stored in Redis once, and the task message
+# only carries their key instead of the whole payload
+TASK_PAYLOAD_REFERENCE_MIN_ITINERARIES = int(os.getenv("SORTER_TASK_PAYLOAD_REFERENCE_MIN_ITINERARIES", "1000"))
+# The batch worker handles up to this many tasks at a time, waiting up to TASK_BATCH_TIMEOUT ms for a batch to fill
+TASK_BATCH_SIZE = int(os.getenv("SORTER_TASK_BATCH_SIZE", "32"))
+TASK_BATCH_TIMEOUT = int(os.getenv("SORTER_TASK_BATCH_TIMEOUT", "100"))
+
+# Admission
+# Requests with more itineraries than this are too costly to sort synchronously, they are scheduled
+# and answered with 202 and a task URL
+SYNC_SORT_MAX_ITINERARIES = int(os.getenv("SORTER_SYNC_SORT_MAX_ITINERARIES", "200000"))
+# Sorts offloaded to the executor at once per API process, further ones get 429, defaults to twice the pool size
+MAX_CONCURRENT_SORTS = int(os.getenv("SORTER_MAX_CONCURRENT_SORTS", "0")) or 2 * SORT_EXECUTOR_WORKERS
+# No more requests are scheduled while this many tasks wait in the queue, they get 429
+MAX_QUEUE_DEPTH = int(os.getenv("SORTER_MAX_QUEUE_DEPTH", "1000"))
+# Seconds clients are asked to wait before retrying a request turned away with 429
+RETRY_AFTER = int(os.getenv("SORTER_RETRY_AFTER", "5"))
+# Largest page a client can read at once, the whole result is streamed as NDJSON instead
+MAX_PAGE_SIZE = int(os.getenv("SORTER_MAX_PAGE_SIZE", "1000"))
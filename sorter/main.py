@@ -1,20 +1,48 @@
+import asyncio
 import logging
-import uuid
-import redis
-import json
+import time
+import orjson
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Query, Request
-from fastapi.responses import RedirectResponse
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
 from pydantic import ValidationError
 
-from sorter.schemas.itinerirary_schemas import SortResponse, SortRequest, SortResponseUnion
-from sorter.api.v1.endpoints.sort_itineriraries import sort_cheapest, sort_fastest, sort_best
-from sorter.api.v1.tasks import sort_task
-
-# Cache
-# TODO: Replace with a connection to a real database
-redis_client = redis.Redis(host="localhost", port=6379, db=0)
-# Cace here is used when user navigates on a result, so we can store the result for a while
-CACHE_TTL = 1800  # 30 minutes
+from sorter.schemas.itinerirary_schemas import (
+    BatchSortRequest,
+    BatchSortResponse,
+    ScheduledTaskResponse,
+    SortDelta,
+    SortOptions,
+    SortResponse,
+    SortRequest,
+    SortResponseUnion,
+    TaskResponseUnion,
+    TaskStatusResponse,
+)
+from sorter.api import executor, metrics, storage
+from sorter.api.engine import SortedItineraries
+from sorter.api.ingest import NDJSON_MEDIA_TYPE, ColumnarSortRequest, parse_ndjson_sort_request
+from sorter.api.v1.endpoints.sort_itineriraries import (
+    body_size,
+    merge_delta,
+    prepare_batch,
+    prepare_request,
+    request_fingerprint,
+    sort_and_encode,
+    sort_request_offloaded,
+    sort_stored_request,
+)
+from sorter.api.rates import load_rate_table
+from sorter.config import (
+    MAX_PAGE_SIZE,
+    MAX_QUEUE_DEPTH,
+    RETRY_AFTER,
+    SERVER_TIMING,
+    SYNC_SORT_MAX_ITINERARIES,
+    TASK_PAYLOAD_REFERENCE_MIN_ITINERARIES,
+    TOP_K_WINDOW,
+)
 
 # Logging
 # Set up Logging, Adapt to log to file or ...
@@ -23,11 +51,55 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load exchange rates, open the shared Redis pool and start the sorting pool once per process
+    load_rate_table()
+    storage.connect()
+    executor.start()
+    yield
+    executor.shutdown()
+    await storage.close()
+
+
 app = FastAPI(
     title="Itinerary Sorting API",
     description="An API to sort itineraries based on price, duration, or a combination of both",
     version="1.0.0",
+    lifespan=lifespan,
 )
+app.add_middleware(metrics.MetricsMiddleware, server_timing=SERVER_TIMING)
+
+
+def openapi() -> dict:
+    # Request bodies parsed straight into columns aren't parameters of any route,
+    # add their models to the schema for the request body references
+    if not app.openapi_schema:
+        schema = get_openapi(title=app.title, version=app.version, description=app.description, routes=app.routes)
+        schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+        for model in (SortRequest, BatchSortRequest):
+            definitions = model.model_json_schema(ref_template="#/components/schemas/{model}")
+            for name, definition in definitions.pop("$defs", {}).items():
+                schemas.setdefault(name, definition)
+            schemas[model.__name__] = definitions
+        app.openapi_schema = schema
+    return app.openapi_schema
+
+
+app.openapi = openapi
+
+
+def retry_later(detail: str) -> JSONResponse:
+    return JSONResponse(status_code=429, content={"detail": detail}, headers={"Retry-After": str(RETRY_AFTER)})
+
+
+@app.exception_handler(executor.Overloaded)
+async def overloaded_handler(http_request: Request, e: executor.Overloaded):
+    # Every sort slot of this process is taken, the client retries instead of waiting in line
+    metrics.ADMISSIONS.labels("overloaded").inc()
+    return retry_later(str(e))
 
 
 @app.get("/", include_in_schema=False)
@@ -35,14 +107,39 @@ async def root():
     return RedirectResponse(url="/docs")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
 @app.post(
     "/sort_itineraries",
     response_model=SortResponseUnion,
     description=(
         "Sort itineraries based on specified criteria. If `schedule_task` parameter is set to `true`, "
         "the request is handled asynchronously, and a `task_url` is returned. "
-        "Use the `task_url` to check back for the sorted results once ready."
+        "Use the `task_url` to check back for the sorted results once ready. "
+        f"Requests with more than {SYNC_SORT_MAX_ITINERARIES} itineraries are always scheduled, "
+        "they are answered with `202` and a `task_url` unless their result is already cached. "
+        f"Itineraries can also be streamed as `{NDJSON_MEDIA_TYPE}`, one per line, with `sorting_type`, "
+        "`price_weight` and `duration_weight` as query parameters. "
+        f"With `Accept: {NDJSON_MEDIA_TYPE}` every sorted itinerary is streamed back, one per line."
     ),
+    # The body is parsed by `parse_sort_request` straight into columns, it is documented as a `SortRequest`
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {"schema": {"$ref": "#/components/schemas/SortRequest"}},
+                NDJSON_MEDIA_TYPE: {"schema": {"$ref": "#/components/schemas/Itinerary"}},
+            },
+        }
+    },
+    responses={
+        200: {"content": {NDJSON_MEDIA_TYPE: {"schema": {"$ref": "#/components/schemas/Itinerary"}}}},
+        202: {"model": ScheduledTaskResponse, "description": "Request is too large to sort synchronously"},
+        429: {"description": "Too many sorts are running or scheduled, retry after `Retry-After` seconds"},
+    },
 )
 @app.get(
     "/sort_itineraries",
@@ -51,105 +148,467 @@ async def root():
 )
 async def sort_itineraries(
     http_request: Request,
-    request: SortRequest | None = None,
     schedule_task: bool = Query(
         False, description="If true, schedules the task for background processing and returns a task URL."
     ),
     page: int = Query(1, ge=1),
-    page_size: int = Query(10, ge=1),
+    page_size: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
     cache_key: str | None = None
 ):
-    if http_request.method == "POST" and not cache_key and not request:
+    request, request_key = None, None
+    if http_request.method == "POST":
+        if http_request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+            # Itineraries are parsed while they are received, the sorting options come in the query
+            options = {
+                name: value for name, value in http_request.query_params.items() if name in SortOptions.model_fields
+            }
+            with metrics.stage("validation"):
+                request = await parse_ndjson_sort_request(http_request.stream(), options)
+        elif body := await http_request.body():
+            # Parsed and fingerprinted in one go off the event loop
+            request, request_key = await executor.run(prepare_request, body, size=body_size(body))
+    if request:
+        metrics.describe(request.sorting_type, len(request.columns))
+    if not cache_key and not request:
         raise HTTPException(status_code=400, detail="Request body required for initial sorting")
 
-    if http_request.method == "POST" and schedule_task:
-        if request.sorting_type not in ["cheapest", "fastest", "best"]:
-            raise ValueError("Invalid sorting_type")
-        task_id = str(uuid.uuid4())
-        sort_task.send(task_id, request.dict())
-        task_url = str(http_request.url_for("get_sorting_results", task_id=task_id))
-        return {"task_url": task_url}
+    columns = None
+    if not cache_key:
+        columns = request.columns
+        try:
+            if request_key is None:
+                request_key = await executor.run(request_fingerprint, request, size=len(columns))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        cache_key = request_key
 
-    if cache_key:
-        cached_data = redis_client.get(cache_key)
-        if not cached_data:
-            raise HTTPException(status_code=404, detail="Cache not found or expired")
+        oversized = len(columns) > SYNC_SORT_MAX_ITINERARIES
+        if schedule_task or oversized:
+            task_url = str(http_request.url_for("get_sorting_results", task_id=cache_key))
+            if not await storage.has_sorted_itineraries(cache_key):
+                # The task id is the request fingerprint, identical requests share one task and its result
+                if not await schedule_once(cache_key, request):
+                    metrics.ADMISSIONS.labels("queue_full").inc()
+                    return retry_later("Too many sorts are scheduled, try again later")
+                if not schedule_task:
+                    metrics.ADMISSIONS.labels("scheduled").inc()
+                    return JSONResponse(status_code=202, content={"task_url": task_url})
+            if schedule_task:
+                return {"task_url": task_url}
 
-        sorted_itineraries = json.loads(cached_data)
-    else:
+    stream = accepts_ndjson(http_request)
+    if stream and columns is not None:
+        # Streamed responses hold every sorted itinerary, they are sorted in full straight from the request
+        response = await sort_request_offloaded(request, columns=columns)
+        return StreamingResponse(iter_ndjson(response["sorted_itineraries"]), media_type=NDJSON_MEDIA_TYPE)
+
+    # Cache hits are served with a single pipelined round trip
+    meta, paginated_itineraries = await read_page(cache_key, page, page_size)
+    if not meta and columns is not None:
+        limit = max(page * page_size, TOP_K_WINDOW)
         try:
-            if request.sorting_type == "cheapest":
-                response = await sort_cheapest(request)
-            elif request.sorting_type == "fastest":
-                response = await sort_fastest(request)
-            elif request.sorting_type == "best":
-                response = await sort_best(request)
-            else:
-                raise HTTPException(status_code=400, detail="Invalid sorting_type provided")
+            await coalesce(cache_key, lambda: sort_and_store(cache_key, request, limit))
         except ValidationError as e:
             raise HTTPException(status_code=422, detail=e.errors())
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
+        except executor.Overloaded:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"An unexpected error occurred. {e.args}")
+        meta, paginated_itineraries = await read_page(cache_key, page, page_size)
 
-        sorted_itineraries = response["sorted_itineraries"]
-
-        cache_key = str(uuid.uuid4())
-        redis_client.setex(cache_key, CACHE_TTL, json.dumps(sorted_itineraries))
-
-    total_itineraries = len(sorted_itineraries)
-    start = (page - 1) * page_size
-    end = start + page_size
-    paginated_itineraries = sorted_itineraries[start:end]
+    if not meta:
+        raise HTTPException(status_code=404, detail="Cache not found or expired")
+    if not request:
+        metrics.describe("cached", meta["total"])
+    if stream:
+        return await stream_result(cache_key, meta)
 
-    base_url = str(http_request.url_for("sort_itineraries"))
-    next_url = f"{base_url}?cache_key={cache_key}&page={page + 1}&page_size={page_size}" if end < total_itineraries else None
-    previous_url = f"{base_url}?cache_key={cache_key}&page={page - 1}&page_size={page_size}" if start > 0 else None
-
-    paginated_response = SortResponse(
+    return paginate(
+        http_request,
         sorting_type=request.sorting_type if request else "cached",
+        paginated_itineraries=paginated_itineraries,
+        total_itineraries=meta["total"],
         page=page,
         page_size=page_size,
-        total=total_itineraries,
-        next=next_url,
-        previous=previous_url,
-        sorted_itineraries=paginated_itineraries,
+        base_url=str(http_request.url_for("sort_itineraries")),
+        cache_key=cache_key,
     )
-    return paginated_response
 
 
-@app.get("/sort_itineraries/{task_id}", response_model=SortResponse)
+@app.post(
+    "/sort_itineraries/batch",
+    response_model=BatchSortResponse,
+    description=(
+        "Sort several sets of itineraries, each by one or more sorting types, in one request. "
+        "Each set is parsed and its prices converted once for all of its sorting types. "
+        "The response holds the first page of every result, with the `cache_key` to read the other pages."
+    ),
+    openapi_extra={
+        "requestBody": {"content": {"application/json": {"schema": {"$ref": "#/components/schemas/BatchSortRequest"}}}}
+    },
+)
+async def sort_itineraries_batch(http_request: Request, page_size: int = Query(10, ge=1, le=MAX_PAGE_SIZE)):
+    body = await http_request.body()
+    jobs, cache_keys = await executor.run(prepare_batch, body, size=body_size(body))
+    size = sum(len(requests[0].columns) for requests in jobs)
+    metrics.describe("batch", size)
+    if size > SYNC_SORT_MAX_ITINERARIES:
+        # Batches can't be scheduled as one task
+        raise HTTPException(
+            status_code=413,
+            detail=f"A batch holds at most {SYNC_SORT_MAX_ITINERARIES} itineraries, schedule larger jobs one by one",
+        )
+
+    try:
+        await asyncio.gather(*(
+            sort_job(requests, job_keys, max(page_size, TOP_K_WINDOW)) for requests, job_keys in zip(jobs, cache_keys)
+        ))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    base_url = str(http_request.url_for("sort_itineraries"))
+    results = []
+    for requests, job_keys in zip(jobs, cache_keys):
+        pages = await asyncio.gather(*(read_page(cache_key, 1, page_size) for cache_key in job_keys))
+        for request, cache_key, (meta, paginated_itineraries) in zip(requests, job_keys, pages):
+            if not meta:
+                raise HTTPException(status_code=404, detail="Cache not found or expired")
+            results.append(render_page(
+                sorting_type=request.sorting_type,
+                paginated_itineraries=paginated_itineraries,
+                total_itineraries=meta["total"],
+                page=1,
+                page_size=page_size,
+                base_url=base_url,
+                cache_key=cache_key,
+            ))
+
+    # Stitch the rendered pages into one list per job
+    content, offset = [], 0
+    for requests in jobs:
+        content.append(b"[" + b",".join(results[offset:offset + len(requests)]) + b"]")
+        offset += len(requests)
+    return Response(content=b'{"results":[' + b",".join(content) + b"]}", media_type="application/json")
+
+
+@app.get(
+    "/sort_itineraries/{task_id}",
+    response_model=TaskResponseUnion,
+    responses={202: {"model": TaskStatusResponse, "description": "Task is pending or running"}},
+)
 async def get_sorting_results(
     http_request: Request,
     task_id: str,
     page: int = Query(1, ge=1),
-    page_size: int = Query(10, ge=1),
+    page_size: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
 ):
-    cached_data = redis_client.get(task_id)
-    if not cached_data:
-        raise HTTPException(status_code=404, detail="Result not found or still processing ...")
+    meta, paginated_itineraries = await read_page(task_id, page, page_size, refresh_ttl=True)
+    if not meta:
+        status = await storage.load_status(task_id)
+        if not status or status["status"] == "done":
+            raise HTTPException(status_code=404, detail="Task not found or expired")
 
-    sorted_itineraries = json.loads(cached_data)
-    cache_key = str(uuid.uuid4())
-    redis_client.setex(cache_key, CACHE_TTL, json.dumps(sorted_itineraries))
+        status_response = TaskStatusResponse(task_id=task_id, **status)
+        if status_response.status in ("pending", "running"):
+            return JSONResponse(status_code=202, content=status_response.model_dump())
+        return status_response
 
-    total_itineraries = len(sorted_itineraries)
-    start = (page - 1) * page_size
-    end = start + page_size
-    paginated_itineraries = sorted_itineraries[start:end]
+    metrics.describe("cached", meta["total"])
+    if accepts_ndjson(http_request):
+        return await stream_result(task_id, meta)
+    return paginate(
+        http_request,
+        sorting_type="cached",
+        paginated_itineraries=paginated_itineraries,
+        total_itineraries=meta["total"],
+        page=page,
+        page_size=page_size,
+        base_url=str(http_request.url_for("get_sorting_results", task_id=task_id)),
+    )
 
-    base_url = str(http_request.url_for("sort_itineraries"))
-    next_url = f"{base_url}?cache_key={cache_key}&page={page + 1}&page_size={page_size}" if end < total_itineraries else None
-    previous_url = f"{base_url}?cache_key={cache_key}&page={page - 1}&page_size={page_size}" if start > 0 else None
 
-    paginated_response = SortResponse(
-        sorting_type="cached",
+@app.post(
+    "/sort_itineraries/{cache_key}/delta",
+    response_model=SortResponse,
+    description=(
+        "Add itineraries to, or remove them by id from, a cached result (`cache_key`) or the result of a task "
+        "(task id). The added itineraries are merged into the stored order instead of sorting everything again, "
+        "the updated result is stored under the returned `cache_key`."
+    ),
+)
+async def update_sorted_itineraries(
+    http_request: Request,
+    cache_key: str,
+    delta: SortDelta,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+):
+    meta = await storage.load_meta(cache_key)
+    if meta and meta["sorted"] < meta["total"]:
+        meta = await complete_result(cache_key, meta["total"])
+    if meta:
+        _, sorted_itineraries = await storage.load_page(cache_key, 0, meta["total"])
+    if not meta or len(sorted_itineraries) != meta["total"]:
+        raise HTTPException(status_code=404, detail="Cache not found or expired")
+    if "options" not in meta or meta["options"].get("fields"):
+        raise HTTPException(status_code=409, detail="This result can't be updated, sort the itineraries again")
+
+    options = meta["options"]
+    metrics.describe(options["sorting_type"], meta["total"] + len(delta.add))
+    try:
+        merged_key = await merge_and_store(sorted_itineraries, delta, options)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    meta, paginated_itineraries = await read_page(merged_key, page, page_size)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Cache not found or expired")
+    return paginate(
+        http_request,
+        sorting_type=options["sorting_type"],
+        paginated_itineraries=paginated_itineraries,
+        total_itineraries=meta["total"],
         page=page,
         page_size=page_size,
-        total=total_itineraries,
-        next=next_url,
-        previous=previous_url,
-        sorted_itineraries=paginated_itineraries,
+        base_url=str(http_request.url_for("sort_itineraries")),
+        cache_key=merged_key,
+    )
+
+
+# Streamed responses are built and sent this many itineraries at a time
+STREAM_CHUNK_SIZE = 10_000
+
+# Sorts currently running in this process, keyed by request fingerprint
+_inflight_sorts: dict[str, asyncio.Task] = {}
+
+
+async def coalesce(cache_key: str, sort):
+    """
+    Run `sort` once per cache key, concurrent identical requests await the same in-flight sort.
+    """
+    task = _inflight_sorts.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(sort())
+        _inflight_sorts[cache_key] = task
+        task.add_done_callback(lambda _: _inflight_sorts.pop(cache_key, None))
+    return await asyncio.shield(task)
+
+
+async def schedule_once(task_id: str, request: ColumnarSortRequest) -> bool:
+    """
+    Schedule a request unless its task is already pending or running,
+    returns False when too many tasks wait in the queue to take another one.
+    """
+    status = await storage.load_status(task_id)
+    if status and status["status"] in ("pending", "running"):
+        return True
+    if await storage.queue_depth() >= MAX_QUEUE_DEPTH:
+        return False
+    if await storage.mark_pending(task_id):
+        await schedule_sort(task_id, request)
+    return True
+
+
+async def schedule_sort(task_id: str, request: ColumnarSortRequest):
+    """
+    Send a request to the worker, large payloads are stored in Redis once and sent by reference
+    so they don't go through the broker. They are stored from the columns, see `ColumnarSortRequest.dumps`.
+    """
+    # Dramatiq and the broker are only loaded once the first task is scheduled, not when the API starts
+    from sorter.api.v1.tasks import sort_task
+
+    # The broker client is synchronous, messages are sent from a thread so the event loop isn't blocked
+    if len(request.columns) >= TASK_PAYLOAD_REFERENCE_MIN_ITINERARIES:
+        await storage.store_request(task_id, await executor.run(request.dumps, size=len(request.columns)))
+        await asyncio.to_thread(sort_task.send, task_id)
+    else:
+        await asyncio.to_thread(sort_task.send, task_id, request.as_payload())
+
+
+async def sort_and_store(cache_key: str, request: ColumnarSortRequest, limit: int) -> dict:
+    """
+    Sort and cache a request, unless another process holds the lock for it and stores the result first.
+    """
+    token = await storage.acquire_lock(cache_key)
+    if token is None:
+        meta = await wait_for_sorted_itineraries(cache_key)
+        if meta:
+            return meta
+        # The other process gave up, sort it here and hold the lock if it's free now
+        token = await storage.acquire_lock(cache_key)
+
+    try:
+        # The request comes back with the result when only a window was sorted, so the rest can be sorted
+        # if the client pages past the window
+        (items, meta, stored_request), = await executor.run(
+            sort_and_encode, [request], limit, size=len(request.columns)
+        )
+        return await storage.store_encoded_itineraries(cache_key, items, meta, stored_request)
+    finally:
+        if token is not None:
+            await storage.release_lock(cache_key, token)
+
+
+async def sort_job(requests: list[ColumnarSortRequest], cache_keys: list[str], limit: int):
+    """
+    Sort and cache every result of a batch job that isn't cached yet. The requests share their columns,
+    they are sorted in a single executor call so converted prices are reused across sorting types.
+    """
+    # Identical sorting types of a job share a cache key, they are sorted once
+    missing = {}
+    for request, cache_key in zip(requests, cache_keys):
+        if cache_key not in missing and not await storage.has_sorted_itineraries(cache_key):
+            missing[cache_key] = request
+    if not missing:
+        return
+
+    pending, tokens = {}, {}
+    for cache_key, request in missing.items():
+        token = await storage.acquire_lock(cache_key)
+        if token is None:
+            if await wait_for_sorted_itineraries(cache_key):
+                continue
+            token = await storage.acquire_lock(cache_key)
+        if token is not None:
+            tokens[cache_key] = token
+        pending[cache_key] = request
+    try:
+        if not pending:
+            return
+        results = await executor.run(
+            sort_and_encode, list(pending.values()), limit, size=len(requests[0].columns) * len(pending)
+        )
+        for cache_key, (items, meta, stored_request) in zip(pending, results):
+            await storage.store_encoded_itineraries(cache_key, items, meta, stored_request)
+    finally:
+        # Only the locks taken here are released, the others belong to the processes still sorting them
+        for cache_key, token in tokens.items():
+            await storage.release_lock(cache_key, token)
+
+
+async def merge_and_store(sorted_itineraries: list[bytes], delta: SortDelta, options: dict) -> str:
+    """
+    Merge `delta` into serialized itineraries that are already sorted by `options` and cache the result,
+    returns its cache key. See `merge_delta`, which runs in the executor.
+    """
+    merged_key, items, meta = await executor.run(
+        merge_delta, sorted_itineraries, delta, options, size=len(sorted_itineraries) + len(delta.add)
     )
-    return paginated_response
+    if not await storage.has_sorted_itineraries(merged_key):
+        await storage.store_encoded_itineraries(merged_key, items, meta)
+    return merged_key
+
+
+async def wait_for_sorted_itineraries(cache_key: str) -> dict | None:
+    deadline = time.monotonic() + storage.LOCK_TTL
+    while await storage.is_locked(cache_key) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return await storage.load_meta(cache_key)
+
+
+async def read_page(
+    cache_key: str,
+    page: int,
+    page_size: int,
+    refresh_ttl: bool = False,
+) -> tuple[dict | None, list[bytes]]:
+    """
+    Read one page of a cached result, sorting the rest of a partially sorted result
+    the first time a page past the sorted window is requested.
+    """
+    start = (page - 1) * page_size
+    end = start + page_size
+    meta, paginated_itineraries = await storage.load_page(cache_key, start, end, refresh_ttl=refresh_ttl)
+    if meta and meta["sorted"] < meta["total"] and end > meta["sorted"]:
+        if await complete_result(cache_key, meta["total"]):
+            meta, paginated_itineraries = await storage.load_page(cache_key, start, end)
+
+    return meta, paginated_itineraries
+
+
+async def complete_result(cache_key: str, total: int) -> dict | None:
+    """
+    Sort all `total` itineraries of a partially sorted result and store them, returns the meta of the
+    completed result or None when the request it was sorted from expired.
+    """
+    stored_request = await storage.load_request(cache_key)
+    if stored_request is None:
+        return None
+    items, meta = await executor.run(sort_stored_request, stored_request, size=total)
+    return await storage.store_encoded_itineraries(cache_key, items, meta)
+
+
+def accepts_ndjson(http_request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in http_request.headers.get("accept", "")
+
+
+def iter_ndjson(sorted_itineraries: SortedItineraries):
+    # Serialized a chunk at a time, so only one chunk of the response is built in memory
+    for start in range(0, len(sorted_itineraries), STREAM_CHUNK_SIZE):
+        yield b"\n".join(sorted_itineraries.serialize(slice(start, start + STREAM_CHUNK_SIZE))) + b"\n"
+
+
+async def stream_result(cache_key: str, meta: dict) -> StreamingResponse:
+    """
+    Stream a cached result as NDJSON, read from Redis a chunk at a time.
+    """
+    if meta["sorted"] < meta["total"]:
+        await complete_result(cache_key, meta["total"])
+
+    async def chunks():
+        for start in range(0, meta["total"], STREAM_CHUNK_SIZE):
+            _, items = await storage.load_page(cache_key, start, start + STREAM_CHUNK_SIZE)
+            if items:
+                yield b"\n".join(items) + b"\n"
+
+    return StreamingResponse(chunks(), media_type=NDJSON_MEDIA_TYPE)
+
+
+def paginate(
+    http_request: Request,
+    sorting_type: str,
+    paginated_itineraries: list[bytes],
+    total_itineraries: int,
+    page: int,
+    page_size: int,
+    base_url: str,
+    cache_key: str | None = None,
+) -> Response:
+    """
+    Render a `SortResponse` page around the serialized itineraries, the items are copied
+    into the body as they are instead of being parsed and validated again.
+    """
+    content = render_page(sorting_type, paginated_itineraries, total_itineraries, page, page_size, base_url, cache_key)
+    return Response(content=content, media_type="application/json")
+
+
+def render_page(
+    sorting_type: str,
+    paginated_itineraries: list[bytes],
+    total_itineraries: int,
+    page: int,
+    page_size: int,
+    base_url: str,
+    cache_key: str | None = None,
+) -> bytes:
+    start = (page - 1) * page_size
+    end = start + page_size
+
+    query = f"?cache_key={cache_key}&" if cache_key else "?"
+    next_url = f"{base_url}{query}page={page + 1}&page_size={page_size}" if end < total_itineraries else None
+    previous_url = f"{base_url}{query}page={page - 1}&page_size={page_size}" if start > 0 else None
+
+    envelope = orjson.dumps({
+        "sorting_type": sorting_type,
+        "page": page,
+        "page_size": page_size,
+        "total": total_itineraries,
+        "next": next_url,
+        "previous": previous_url,
+        "cache_key": cache_key,
+        "sorted_itineraries": [],
+    })
+    # `sorted_itineraries` is the last field, splice the items into its empty list
+    return b"".join((envelope[:-2], b",".join(paginated_itineraries), b"]}"))
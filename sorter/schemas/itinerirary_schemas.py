@@ -1,26 +1,100 @@
+import json
+
 from pydantic import BaseModel, Field, field_validator, HttpUrl
 from typing import List, Literal, Optional, Union
 
+from sorter.api.rates import get_rate_table
+from sorter.config import MAX_ID_LENGTH
+
 
 class Price(BaseModel):
     amount: float
     currency: str
 
+    @field_validator("currency")
+    def check_currency_supported(cls, currency):
+        get_rate_table().currency_index(currency)
+        return currency
+
 
 class Itinerary(BaseModel):
-    id: str
-    duration_minutes: int
+    id: str = Field(..., max_length=MAX_ID_LENGTH)
+    duration_minutes: int = Field(..., ge=0)
     price: Price
 
 
-class SortRequest(BaseModel):
+class SortFilters(BaseModel):
     """
-    Model representing the request to sort itineraries based on a specified type,
-    with optional weighting for price and duration in the "best" sort.
+    Model representing which itineraries to keep, only those matching every given predicate are sorted.
+    """
+    max_price_eur: Optional[float] = None
+    min_duration_minutes: Optional[int] = None
+    max_duration_minutes: Optional[int] = None
+    currencies: Optional[List[str]] = Field(None, description="Currencies to keep the itineraries of.")
+    ids: Optional[List[str]] = Field(None, description="Ids of the itineraries to keep.")
+
+    @field_validator("currencies")
+    def check_currencies_supported(cls, currencies):
+        for currency in currencies or []:
+            get_rate_table().currency_index(currency)
+        return currencies
+
+
+# Fields of the sorted itineraries a response can be limited to
+ItineraryField = Literal["id", "duration_minutes", "price"]
+
+# Keys that order itineraries whose sorting type key ties, a "-" prefix orders by the key descending
+ThenByKey = Literal["price_eur", "-price_eur", "duration", "-duration", "score", "-score", "id", "-id"]
+
+
+class SortOptions(BaseModel):
+    """
+    Model representing how to sort itineraries, the sorting type, the optional
+    weighting for price and duration in the "best" sort and the keys that break ties.
     """
     sorting_type: Literal["cheapest", "fastest", "best"]
     price_weight: Optional[float] = 0.5
     duration_weight: Optional[float] = 0.5
+    then_by: List[ThenByKey] = Field(
+        [],
+        description=(
+            "Keys to order itineraries by, in turn, when the key of the sorting type ties, prefixed with '-' "
+            "for descending. The key of the sorting type always comes first and is always ascending."
+        ),
+        examples=[["duration", "-id"]],
+    )
+    filters: Optional[SortFilters] = None
+    fields: Optional[List[ItineraryField]] = Field(
+        None, description="Fields to return for each itinerary, all of them by default.", examples=[["id", "price"]]
+    )
+
+    @field_validator("then_by", "fields", mode="before")
+    def split_keys(cls, keys):
+        # Query parameters give the keys comma separated
+        if isinstance(keys, str):
+            return [key.strip() for key in keys.split(",") if key.strip()]
+        return keys
+
+    @field_validator("filters", mode="before")
+    def parse_filters(cls, filters):
+        # Query parameters give the filters as a JSON object
+        if isinstance(filters, str):
+            return json.loads(filters)
+        return filters
+
+    @field_validator("duration_weight")
+    def check_weights_sum(cls, duration_weight, values):
+        price_weight = values.data.get("price_weight", 0.5)
+        if price_weight + duration_weight != 1:
+            raise ValueError("price_weight and duration_weight must sum up to 1")
+        return duration_weight
+
+
+class SortRequest(SortOptions):
+    """
+    Model representing the request to sort itineraries based on a specified type,
+    with optional weighting for price and duration in the "best" sort.
+    """
     itineraries: List[Itinerary] = Field(
         ...,
         example=[
@@ -51,12 +125,38 @@ class SortRequest(BaseModel):
         ]
     )
 
-    @field_validator("duration_weight", mode="before")
+
+class BatchSortJob(BaseModel):
+    """
+    Model representing one set of itineraries in a batch, sorted by each of `sorting_types`
+    with the same weighting for price and duration.
+    """
+    sorting_types: List[Literal["cheapest", "fastest", "best"]] = Field(..., min_length=1)
+    price_weight: Optional[float] = 0.5
+    duration_weight: Optional[float] = 0.5
+    then_by: List[ThenByKey] = []
+    filters: Optional[SortFilters] = None
+    fields: Optional[List[ItineraryField]] = None
+    itineraries: List[Itinerary]
+
+    @field_validator("duration_weight")
     def check_weights_sum(cls, duration_weight, values):
-        price_weight = values.data.get("price_weight", 0.5)
-        if price_weight + duration_weight != 1:
-            raise ValueError("price_weight and duration_weight must sum up to 1")
-        return duration_weight
+        return SortOptions.check_weights_sum(duration_weight, values)
+
+
+class BatchSortRequest(BaseModel):
+    """
+    Model representing several sets of itineraries to sort in one request.
+    """
+    jobs: List[BatchSortJob] = Field(..., min_length=1)
+
+
+class SortDelta(BaseModel):
+    """
+    Model representing itineraries to add to and remove (by id) from an existing sorted result.
+    """
+    add: List[Itinerary] = []
+    remove: List[str] = []
 
 
 class SortResponse(BaseModel):
@@ -70,9 +170,18 @@ class SortResponse(BaseModel):
     total: int
     next: Optional[HttpUrl] = None
     previous: Optional[HttpUrl] = None
+    cache_key: Optional[str] = None
     sorted_itineraries: List[Itinerary]
 
 
+class BatchSortResponse(BaseModel):
+    """
+    Model representing the first page of every result of a batch, one list per job
+    in the order of its `sorting_types`.
+    """
+    results: List[List[SortResponse]]
+
+
 class ScheduledTaskResponse(BaseModel):
     """
     Model for the asynchronous response when a sorting task is scheduled.
@@ -80,4 +189,14 @@ class ScheduledTaskResponse(BaseModel):
     task_url: HttpUrl
 
 
+class TaskStatusResponse(BaseModel):
+    """
+    Model for the status of a scheduled sorting task whose result is not available.
+    """
+    task_id: str
+    status: Literal["pending", "running", "done", "failed"]
+    detail: Optional[str] = None
+
+
 SortResponseUnion = Union[SortResponse, ScheduledTaskResponse]
+TaskResponseUnion = Union[SortResponse, TaskStatusResponse]
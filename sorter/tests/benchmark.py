@@ -0,0 +1,276 @@
+"""
+Benchmark the sorting pipeline stage by stage, against the app running in process.
+
+    python -m sorter.tests.benchmark --sizes 1000 10000 100000 1000000 --baseline benchmark_baseline.json
+
+Results are compared to the baseline file when it exists, the run fails when a stage got slower or
+uses more memory than the baseline allows. Use `--save-baseline` to write the results as the new baseline.
+Redis is an in-memory fakeredis server unless `--redis-url` points at a local Redis.
+Cold imports of the API and the worker are timed too, each in a fresh interpreter, so their startup
+time and memory are held to the baseline like any stage.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import fakeredis
+import httpx
+import numpy as np
+import orjson
+
+from sorter.api import storage
+from sorter.api.engine import SORT_KEYS, SortedItineraries, fingerprint, sort_order
+from sorter.api.ingest import parse_sort_request
+from sorter.api.rates import load_rate_table
+from sorter.config import TOP_K_WINDOW
+from sorter.main import app
+from sorter.tests.payloads.payload_generator import CURRENCIES, generate_payload
+
+STAGES = ["parse", "convert", "score", "sort", "top_k", "serialize", "redis_write", "page_read"]
+PAGE_SIZE = 10
+# A stage only counts as a regression when it is slower by more than the tolerance and by more than
+# these absolute amounts, so timer noise on stages that take microseconds doesn't fail the run
+MIN_REGRESSION_MS = 1.0
+MIN_REGRESSION_MB = 1.0
+# Entry points whose cold import is timed, keyed by the name they are reported under
+STARTUP_MODULES = {"api": "sorter.main", "worker": "sorter.api.v1.worker"}
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_IMPORT_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "ms": elapsed * 1000,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": sorted(sys.modules),
+}}))
+"""
+
+
+class StageTimer:
+    """
+    Collect the duration of each stage across runs, or its peak memory when `trace_memory` is set.
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.peak_memory = {}
+        self.trace_memory = False
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            allocated, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        if self.trace_memory:
+            self.peak_memory[name] = tracemalloc.get_traced_memory()[1] - allocated
+        else:
+            self.timings[name].append(elapsed)
+
+
+async def run_pipeline(body: bytes, client: httpx.AsyncClient, timer: StageTimer, cache_encoding: str = "json"):
+    """
+    Run one request through every stage the way the API handles it.
+    """
+    with timer.stage("parse"):
+        request = parse_sort_request(body)
+    columns = request.columns
+    with timer.stage("convert"):
+        columns.price_eur
+    with timer.stage("score"):
+        SORT_KEYS[request.sorting_type](columns, request.price_weight, request.duration_weight)
+    with timer.stage("sort"):
+        order = sort_order(columns, request.sorting_type, request.price_weight, request.duration_weight)
+    with timer.stage("top_k"):
+        sort_order(columns, request.sorting_type, request.price_weight, request.duration_weight, limit=TOP_K_WINDOW)
+    sorted_itineraries = SortedItineraries(columns, order)
+    with timer.stage("serialize"):
+        serialized = sorted_itineraries.serialize()
+
+    cache_key = fingerprint(columns, request.sorting_type, request.price_weight, request.duration_weight)
+    # The columnar encoding is built from the columns, it is timed as part of the write
+    stored = serialized if cache_encoding == "json" else sorted_itineraries
+    with timer.stage("redis_write"):
+        await storage.store_sorted_itineraries(cache_key, stored, len(columns), encoding=cache_encoding)
+    # A page from the middle of the result, read through the app like a client paging through it
+    page = len(columns) // PAGE_SIZE // 2 + 1
+    with timer.stage("page_read"):
+        response = await client.get(
+            "/sort_itineraries", params={"cache_key": cache_key, "page": page, "page_size": PAGE_SIZE}
+        )
+    response.raise_for_status()
+
+
+async def run_benchmark(
+    sizes: list[int],
+    sorting_types: list[str],
+    repeat: int = 5,
+    currencies: list[str] = CURRENCIES,
+    currency_weights: list[float] | None = None,
+    seed: int = 42,
+    redis_url: str | None = None,
+    cache_encoding: str = "json",
+) -> dict:
+    """
+    Benchmark every stage for each payload size and sorting type, keyed "<size>/<sorting_type>/<stage>".
+    The first run of each combination measures peak memory and warms up, the next `repeat` runs are timed.
+    """
+    load_rate_table()
+    if redis_url:
+        storage.connect(redis_url)
+    else:
+        storage.redis_client = fakeredis.FakeAsyncRedis()
+    results = {}
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+            for size in sizes:
+                payload = generate_payload(size, currencies, currency_weights, seed=seed)
+                for sorting_type in sorting_types:
+                    body = orjson.dumps({**payload, "sorting_type": sorting_type})
+                    timer = StageTimer()
+
+                    timer.trace_memory = True
+                    tracemalloc.start()
+                    try:
+                        await run_pipeline(body, client, timer, cache_encoding)
+                    finally:
+                        tracemalloc.stop()
+                    timer.trace_memory = False
+                    for _ in range(repeat):
+                        await run_pipeline(body, client, timer, cache_encoding)
+
+                    for stage in STAGES:
+                        timings_ms = np.array(timer.timings[stage]) * 1000
+                        results[f"{size}/{sorting_type}/{stage}"] = {
+                            "p50_ms": round(float(np.percentile(timings_ms, 50)), 3),
+                            "p95_ms": round(float(np.percentile(timings_ms, 95)), 3),
+                            "p99_ms": round(float(np.percentile(timings_ms, 99)), 3),
+                            "peak_mb": round(timer.peak_memory[stage] / 2**20, 3),
+                        }
+                    await storage.get_redis().flushdb()
+    finally:
+        await storage.close()
+    return results
+
+
+def import_module(module: str) -> dict:
+    """
+    Import `module` in a fresh interpreter, returns how long it took ("ms"), the peak memory of
+    the process ("max_rss_mb") and every module it loaded ("modules").
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT.format(module=module)],
+        cwd=ROOT,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_startup_benchmark(repeat: int = 5) -> dict:
+    """
+    Time cold imports of every entry point, keyed "startup/<entry point>/import".
+    """
+    results = {}
+    for name, module in STARTUP_MODULES.items():
+        runs = [import_module(module) for _ in range(repeat)]
+        timings_ms = np.array([run["ms"] for run in runs])
+        results[f"startup/{name}/import"] = {
+            "p50_ms": round(float(np.percentile(timings_ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(timings_ms, 95)), 3),
+            "p99_ms": round(float(np.percentile(timings_ms, 99)), 3),
+            "peak_mb": round(max(run["max_rss_mb"] for run in runs), 3),
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """
+    Return a description of every stage whose median time or peak memory regressed from the baseline.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric, min_regression in (("p50_ms", MIN_REGRESSION_MS), ("peak_mb", MIN_REGRESSION_MB)):
+            current, previous = result[metric], baseline[key][metric]
+            if current > previous * (1 + tolerance) and current - previous > min_regression:
+                regressions.append(f"{key} {metric}: {previous} -> {current}")
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"{'size':>8} {'sorting':<9} {'stage':<12} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'peak MB':>10}")
+    for key, result in results.items():
+        size, sorting_type, stage = key.split("/")
+        print(
+            f"{size:>8} {sorting_type:<9} {stage:<12} {result['p50_ms']:>10.3f} {result['p95_ms']:>10.3f} "
+            f"{result['p99_ms']:>10.3f} {result['peak_mb']:>10.3f}"
+        )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the sorting pipeline")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--sorting-types", nargs="+", default=list(SORT_KEYS), choices=list(SORT_KEYS))
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per size and sorting type")
+    parser.add_argument("--currencies", nargs="+", default=CURRENCIES)
+    parser.add_argument("--currency-weights", nargs="+", type=float, help="Relative weight of each currency")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--redis-url", help="Use this Redis instead of an in-memory fakeredis server")
+    parser.add_argument("--cache-encoding", default="json", choices=storage.ENCODINGS, help="How results are stored")
+    parser.add_argument("--baseline", help="Baseline results file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown over the baseline")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument(
+        "--startup", action=argparse.BooleanOptionalAction, default=True, help="Time cold imports of the entry points"
+    )
+    args = parser.parse_args(argv)
+
+    results = run_startup_benchmark(args.repeat) if args.startup else {}
+    results |= asyncio.run(run_benchmark(
+        args.sizes,
+        args.sorting_types,
+        repeat=args.repeat,
+        currencies=args.currencies,
+        currency_weights=args.currency_weights,
+        seed=args.seed,
+        redis_url=args.redis_url,
+        cache_encoding=args.cache_encoding,
+    ))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
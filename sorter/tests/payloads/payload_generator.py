@@ -1,29 +1,55 @@
+import argparse
 import json
 import random
 
-num_itineraries = 100
-currencies = ["EUR", "USD", "CZK", "GBP", "JPY", "AUD", "CAD"]
+CURRENCIES = ["EUR", "USD", "CZK", "GBP", "JPY", "AUD", "CAD"]
 
-itineraries = [
-    {
-        "id": f"itinerary_{i+1}",
-        "duration_minutes": random.randint(60, 480),  # Random duration between 1 and 8 hours
-        "price": {
-            "amount": str(random.randint(100, 10000)),  # Random amount between 100 and 10000
-            "currency": random.choice(currencies)
+
+def generate_payload(
+    num_itineraries: int,
+    currencies: list[str] = CURRENCIES,
+    currency_weights: list[float] | None = None,
+    sorting_type: str = "best",
+    seed: int | None = None,
+) -> dict:
+    """
+    Generate a sort request payload, the same seed always generates the same payload.
+    """
+    rng = random.Random(seed)
+    itinerary_currencies = rng.choices(currencies, weights=currency_weights, k=num_itineraries)
+    itineraries = [
+        {
+            "id": f"itinerary_{i+1}",
+            "duration_minutes": rng.randint(60, 480),  # Random duration between 1 and 8 hours
+            "price": {
+                "amount": str(rng.randint(100, 10000)),  # Random amount between 100 and 10000
+                "currency": currency
+            }
         }
+        for i, currency in enumerate(itinerary_currencies)
+    ]
+
+    return {
+        "sorting_type": sorting_type,
+        "price_weight": 0.5,
+        "duration_weight": 0.5,
+        "itineraries": itineraries
     }
-    for i in range(num_itineraries)
-]
 
-payload = {
-    "sorting_type": "best",
-    "price_weight": 0.5,
-    "duration_weight": 0.5,
-    "itineraries": itineraries
-}
 
-with open(f"{num_itineraries}_itineraries_payload.json", "w") as f:
-    json.dump(payload, f, indent=2)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a sort request payload")
+    parser.add_argument("--count", type=int, default=100, help="Number of itineraries")
+    parser.add_argument("--currencies", nargs="+", default=CURRENCIES)
+    parser.add_argument("--currency-weights", nargs="+", type=float, help="Relative weight of each currency")
+    parser.add_argument("--sorting-type", default="best", choices=["cheapest", "fastest", "best"])
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="Output file, defaults to <count>_itineraries_payload.json")
+    args = parser.parse_args()
+
+    payload = generate_payload(args.count, args.currencies, args.currency_weights, args.sorting_type, args.seed)
+    output = args.output or f"{args.count}_itineraries_payload.json"
+    with open(output, "w") as f:
+        json.dump(payload, f, indent=2)
 
-print(f"Payload with 1000 itineraries saved to {num_itineraries}_itineraries_payload.json")
+    print(f"Payload with {args.count} itineraries saved to {output}")
@@ -1,72 +1,157 @@
+import asyncio
+import json
+import os
+import threading
 import pytest
-import pandas as pd
+import fakeredis
+import numpy as np
 from unittest.mock import patch
+from dramatiq.brokers.stub import StubBroker
+from fastapi import FastAPI
+from fastapi.exceptions import RequestValidationError
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+from sorter.api import codec, executor, metrics, rates, storage
+from sorter.api.rates import RateTable
 from sorter.api.utils import (
     convert_currency,
-    convert_prices_async,
+    convert_prices,
+    normalize,
+    score_itineraries,
 )
-from sorter.api.v1.endpoints.sort_itineriraries import sort_cheapest, sort_fastest, sort_best
+from sorter.api.ingest import (
+    ColumnarSortRequest,
+    parse_batch_sort_request,
+    parse_ndjson_sort_request,
+    parse_sort_request,
+)
+from sorter.api.engine import (
+    ItineraryColumns,
+    SortedItineraries,
+    SORT_KEYS,
+    canonical,
+    filter_columns,
+    hash_rows,
+    merge_order,
+    sort_order,
+)
+from sorter.api.v1.endpoints.sort_itineriraries import request_fingerprint, sort_request, sort_request_offloaded
+from sorter.api.v1 import worker
+from sorter.api.v1.endpoints import sort_itineriraries as endpoints
+from sorter.api.v1.tasks import sort_task
+from sorter.config import MAX_ID_LENGTH, MAX_PAGE_SIZE, RETRY_AFTER
+from sorter.main import app, coalesce, read_page, sort_and_store
+from sorter.tests import benchmark
+from sorter.tests.payloads.payload_generator import generate_payload
 from sorter.schemas.itinerirary_schemas import SortRequest, Itinerary, Price
 
 
+@pytest.fixture
+def fake_redis():
+    """
+    Point the async and sync storage clients at one in-memory server, yields the sync client for assertions.
+    """
+    server = fakeredis.FakeServer()
+    sync_redis_client = fakeredis.FakeRedis(server=server)
+    with patch("sorter.api.storage.redis_client", fakeredis.FakeAsyncRedis(server=server)), \
+            patch("sorter.api.storage.sync_redis_client", sync_redis_client):
+        yield sync_redis_client
+
+
 class TestUtils:
     @pytest.mark.asyncio
     async def test_convert_currency_async_usd_to_eur(self):
-        with patch("sorter.api.utils.CurrencyConverter") as MockCurrencyConverter:
-            mock_instance = MockCurrencyConverter.return_value
-            mock_instance.convert.return_value = 85.0
+        with patch("sorter.api.utils.get_rate_table") as mock_get_rate_table:
+            mock_get_rate_table.return_value = RateTable({"EUR": 1.0, "USD": 0.85})
 
             result = await convert_currency("USD", 100, "EUR")
             assert result == 85.0
 
     @pytest.mark.asyncio
     async def test_convert_currency_async_invalid_currency(self):
-        with patch("sorter.api.utils.CurrencyConverter") as MockCurrencyConverter:
-            mock_instance = MockCurrencyConverter.return_value
-            mock_instance.convert.side_effect = ValueError("Invalid currency")
-            with pytest.raises(ValueError):
-                await convert_currency("INVALID", 100, "EUR")
+        with pytest.raises(ValueError):
+            await convert_currency("INVALID", 100, "EUR")
 
-    @pytest.mark.asyncio
-    async def test_convert_prices_async_valid(self):
-        with patch("sorter.api.utils.convert_currency") as mock_convert_currency:
-            mock_convert_currency.return_value = 85.0
-            itineraries_df = pd.DataFrame({
-                "price_currency": ["USD", "USD"],
-                "price_amount": [100, 200]
-            })
-            await convert_prices_async(itineraries_df)
-            assert itineraries_df["price_eur"].tolist() == [85.0, 85.0]
+    def test_convert_prices_valid(self):
+        with patch("sorter.api.utils.get_rate_table") as mock_get_rate_table:
+            mock_get_rate_table.return_value = RateTable({"EUR": 1.0, "USD": 0.85})
+            result = convert_prices(np.array([100, 200]), np.array(["USD", "USD"]))
+            assert result.tolist() == [85.0, 170.0]
 
-    @pytest.mark.asyncio
-    async def test_convert_prices_async_invalid_currency(self):
-        with patch("sorter.api.utils.convert_currency") as mock_convert_currency:
-            mock_convert_currency.side_effect = ValueError("Invalid currency")
-            itineraries_df = pd.DataFrame({
-                "price_currency": ["INVALID", "USD"],
-                "price_amount": [100, 200]
-            })
-            with pytest.raises(ValueError):
-                await convert_prices_async(itineraries_df)
+    def test_convert_prices_invalid_currency(self):
+        with pytest.raises(ValueError):
+            convert_prices(np.array([100, 200]), np.array(["INVALID", "USD"]))
+
+    def test_normalize_degenerate_ranges(self):
+        assert normalize(np.array([10, 20, 30])).tolist() == [0.0, 0.5, 1.0]
+        assert normalize(np.array([5.0, 5.0])).tolist() == [0.0, 0.0]
+        assert normalize(np.array([], dtype=np.int64)).tolist() == []
+
+        out = np.full(3, np.nan, dtype=np.float32)
+        assert normalize(np.array([7, 7, 7]), out=out) is out
+        assert out.tolist() == [0.0, 0.0, 0.0]
+
+    def test_scores_with_equal_prices_rank_by_duration(self):
+        scores = score_itineraries(np.array([100.0, 100.0, 100.0]), np.array([300, 100, 200]))
+        assert scores.dtype == np.float32
+        assert np.argsort(scores, kind="stable").tolist() == [1, 2, 0]
+
+
+class TestRates:
+    def test_to_eur_mixed_currencies(self):
+        rate_table = RateTable({"EUR": 1.0, "USD": 0.5, "CZK": 0.04})
+        result = rate_table.to_eur(np.array([10.0, 10.0, 100.0, 1.0]), np.array(["USD", "EUR", "CZK", "USD"]))
+        assert result.tolist() == pytest.approx([5.0, 10.0, 4.0, 0.5])
+
+    def test_convert_between_non_eur_currencies(self):
+        rate_table = RateTable({"EUR": 1.0, "USD": 0.5, "CZK": 0.04})
+        assert rate_table.convert(1, "USD", "CZK") == pytest.approx(12.5)
+
+    def test_unknown_currency_raises(self):
+        rate_table = RateTable({"EUR": 1.0})
+        with pytest.raises(ValueError, match="XXX is not a supported currency"):
+            rate_table.to_eur([1.0, 2.0], ["EUR", "XXX"])
+
+    def test_rate_table_is_loaded_once_and_reloaded_on_change(self, tmp_path):
+        from currency_converter import CURRENCY_FILE
+
+        rates_file = tmp_path / "rates.zip"
+        rates_file.write_bytes(open(CURRENCY_FILE, "rb").read())
+        with patch("sorter.api.rates.RATES_RELOAD_INTERVAL", 0):
+            first = rates.load_rate_table(str(rates_file))
+            assert rates.get_rate_table(str(rates_file)) is first
+
+            os.utime(rates_file, (0, 0))
+            reloaded = rates.get_rate_table(str(rates_file))
+            assert reloaded is not first
+            assert reloaded.convert(1, "EUR") == 1.0
 
 
 class TestEndpoints:
-    @pytest.mark.asyncio
-    async def test_sort_cheapest_itineraries(self):
-        with patch("sorter.api.utils.convert_prices_async") as mock_convert_prices_async:
-            mock_convert_prices_async.return_value = None
-            request = SortRequest(
-                itineraries=[
-                    Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
-                    Itinerary(id="2", duration_minutes=90, price=Price(amount=80, currency="CZK"))
-                ],
-                sorting_type="cheapest"
-            )
-            result = await sort_cheapest(request)
-            assert result["sorted_itineraries"][0]["id"] == "2"
+    def test_sort_cheapest_itineraries(self):
+        request = SortRequest(
+            itineraries=[
+                Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
+                Itinerary(id="2", duration_minutes=90, price=Price(amount=80, currency="CZK"))
+            ],
+            sorting_type="cheapest"
+        )
+        result = sort_request(request)
+        assert result["sorted_itineraries"][0]["id"] == "2"
 
-    @pytest.mark.asyncio
-    async def test_sort_fastest_itineraries(self):
+    def test_sort_cheapest_converts_currencies(self):
+        request = SortRequest(
+            itineraries=[
+                Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="EUR")),
+                Itinerary(id="2", duration_minutes=90, price=Price(amount=1000, currency="CZK"))
+            ],
+            sorting_type="cheapest"
+        )
+        result = sort_request(request)
+        assert [item["id"] for item in result["sorted_itineraries"]] == ["2", "1"]
+        assert result["sorted_itineraries"][0]["price"] == {"amount": "1000.0", "currency": "CZK"}
+
+    def test_sort_fastest_itineraries(self):
         request = SortRequest(
             itineraries=[
                 Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
@@ -74,21 +159,1022 @@ class TestEndpoints:
             ],
             sorting_type="fastest"
         )
-        result = await sort_fastest(request)
+        result = sort_request(request)
         assert result["sorted_itineraries"][0]["id"] == "2"
 
-    @pytest.mark.asyncio
-    async def test_sort_best_itineraries(self):
-        with patch("sorter.api.utils.add_score_to_itineraries") as mock_add_score_to_itineraries:
-            mock_add_score_to_itineraries.return_value = None
-            request = SortRequest(
-                itineraries=[
-                    Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
-                    Itinerary(id="2", duration_minutes=90, price=Price(amount=80, currency="CZK"))
-                ],
-                sorting_type="best",
-                price_weight=0.5,
-                duration_weight=0.5
+    def test_sort_best_itineraries(self):
+        request = SortRequest(
+            itineraries=[
+                Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
+                Itinerary(id="2", duration_minutes=90, price=Price(amount=80, currency="CZK"))
+            ],
+            sorting_type="best",
+            price_weight=0.5,
+            duration_weight=0.5
+        )
+        result = sort_request(request)
+        assert result["sorted_itineraries"][0]["id"] == "2"
+
+    def test_sort_unknown_currency(self):
+        with pytest.raises(ValueError):
+            SortRequest(
+                itineraries=[Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="XXX"))],
+                sorting_type="fastest"
+            )
+
+    @pytest.mark.usefixtures("fake_redis")
+    @pytest.mark.parametrize("method", ["GET", "POST"])
+    def test_request_without_body_or_cache_key(self, method):
+        response = TestClient(app).request(method, "/sort_itineraries")
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Request body required for initial sorting"
+
+
+class TestEngine:
+    def test_sort_order_is_a_permutation(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b", "c"]),
+            durations=np.array([300, 100, 200]),
+            amounts=np.array([1.0, 3.0, 2.0]),
+            currencies=np.zeros(3, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        assert sort_order(columns, "fastest").tolist() == [1, 2, 0]
+        assert sort_order(columns, "cheapest").tolist() == [0, 2, 1]
+
+    def test_row_hashes_depend_on_ids_not_their_width(self):
+        def columns(ids):
+            return ItineraryColumns(
+                ids=ids,
+                durations=np.full(len(ids), 100),
+                amounts=np.full(len(ids), 10.0),
+                currencies=np.zeros(len(ids), dtype=np.int16),
+                rate_table=RateTable({"EUR": 1.0}),
             )
-            result = await sort_best(request)
-            assert result["sorted_itineraries"][0]["id"] == "2"
+
+        ids = np.array(["abc", "cba", "ab", "a", ""])
+        hashes = hash_rows(columns(ids))
+        assert len(set(hashes.tolist())) == len(ids)
+        assert hashes.tolist() == hash_rows(columns(ids.astype("<U8"))).tolist()
+
+    def test_then_by_breaks_ties(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b", "c", "d", "e"]),
+            durations=np.array([300, 100, 200, 100, 100]),
+            amounts=np.array([1.0, 1.0, 2.0, 1.0, 1.0]),
+            currencies=np.zeros(5, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        assert sort_order(columns, "cheapest").tolist() == [0, 1, 3, 4, 2]
+        assert sort_order(columns, "cheapest", then_by=["duration"]).tolist() == [1, 3, 4, 0, 2]
+        assert sort_order(columns, "cheapest", then_by=["duration", "-id"]).tolist() == [4, 3, 1, 0, 2]
+        assert sort_order(columns, "fastest", then_by=["-price_eur"]).tolist() == [1, 3, 4, 2, 0]
+        # The top-k window is the prefix of the full order, ties at its edge included
+        for limit in range(1, 6):
+            assert sort_order(columns, "cheapest", limit=limit, then_by=["duration", "-id"]).tolist() == [
+                4, 3, 1, 0, 2
+            ][:limit]
+
+    def test_sorted_itineraries_builds_items_lazily(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b", "c"]),
+            durations=np.array([300, 100, 200]),
+            amounts=np.array([1.0, 3.0, 2.0]),
+            currencies=np.zeros(3, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        sorted_itineraries = SortedItineraries(columns, sort_order(columns, "fastest"))
+        assert len(sorted_itineraries) == 3
+        assert [item["id"] for item in sorted_itineraries[1:]] == ["c", "a"]
+        assert sorted_itineraries[0] == {"id": "b", "duration_minutes": 100, "price": {"amount": "3.0", "currency": "EUR"}}
+
+    def test_serialized_items_match_the_response_model(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b"]),
+            durations=np.array([300, 100]),
+            amounts=np.array([1.5, 20.0]),
+            currencies=np.array([0, 0], dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        sorted_itineraries = SortedItineraries(columns, np.array([1, 0]))
+
+        assert [json.loads(item) for item in sorted_itineraries.serialize(slice(0, 2))] == [
+            Itinerary.model_validate(item).model_dump() for item in sorted_itineraries[0:2]
+        ]
+
+    def test_filter_and_project(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b", "c", "d"]),
+            durations=np.array([300, 100, 200, 50]),
+            amounts=np.array([10.0, 30.0, 20.0, 100.0]),
+            currencies=np.array([0, 1, 0, 1], dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0, "USD": 0.5}),
+        )
+        assert filter_columns(columns) is columns
+        assert filter_columns(columns, max_price_eur=15).ids.tolist() == ["a", "b"]
+        assert filter_columns(columns, min_duration_minutes=100, max_duration_minutes=200).ids.tolist() == ["b", "c"]
+        assert filter_columns(columns, currencies=["USD"], ids=["a", "b", "c"]).ids.tolist() == ["b"]
+
+        kept = filter_columns(columns, max_price_eur=20)
+        sorted_itineraries = SortedItineraries(kept, sort_order(kept, "fastest"), ["id", "price"])
+        assert sorted_itineraries[0] == {"id": "b", "price": {"amount": "30.0", "currency": "USD"}}
+        assert [json.loads(item) for item in sorted_itineraries.serialize()] == [
+            {"id": "b", "price": {"amount": 30.0, "currency": "USD"}},
+            {"id": "c", "price": {"amount": 20.0, "currency": "EUR"}},
+            {"id": "a", "price": {"amount": 10.0, "currency": "EUR"}},
+        ]
+
+    def test_normalized_columns_are_reused_across_weights(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b", "c"]),
+            durations=np.array([300, 100, 200]),
+            amounts=np.array([10.0, 30.0, 20.0]),
+            currencies=np.zeros(3, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        normalized = columns.normalized
+        assert sort_order(columns, "best", 0.9, 0.1).tolist() == [0, 2, 1]
+        assert sort_order(columns, "best", 0.1, 0.9).tolist() == [1, 2, 0]
+        assert columns.normalized is normalized
+        scores = columns.scores(0.3, 0.7)
+        assert np.allclose(scores, 0.3 * normalized[0] + 0.7 * normalized[1])
+        # Rescoring reuses the same float32 buffer
+        assert np.shares_memory(columns.scores(0.5, 0.5), scores)
+        assert scores.dtype == np.float32 and np.allclose(scores, 0.5 * normalized[0] + 0.5 * normalized[1])
+        # Taken columns have other ranges, so they are normalized again
+        assert columns.take(np.array([1, 2])).normalized[1].tolist() == [0.0, 1.0]
+
+    @pytest.mark.parametrize("sorting_type", ["cheapest", "fastest", "best"])
+    def test_merge_matches_full_sort(self, sorting_type):
+        rng = np.random.default_rng(1)
+        columns = ItineraryColumns(
+            ids=np.array([str(i) for i in range(40)]),
+            durations=rng.integers(10, 50, 40),
+            amounts=rng.integers(10, 50, 40).astype(float),
+            currencies=np.zeros(40, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        # The first 30 are sorted, the added ones widen the price and duration ranges "best" is normalized with
+        columns.durations[30:32] = [1, 500]
+        columns.amounts[32] = 1000.0
+        base = columns.take(np.arange(30))
+        merged = ItineraryColumns.concatenate(
+            [base.take(sort_order(base, sorting_type)), columns.take(np.arange(30, 40))]
+        )
+
+        assert merge_order(merged, 30, sorting_type).tolist() == sort_order(merged, sorting_type).tolist()
+
+    @pytest.mark.parametrize("then_by", [(), ("-id",)])
+    @pytest.mark.parametrize("sorting_type", ["cheapest", "fastest", "best"])
+    def test_merge_orders_ties_like_canonical_columns(self, sorting_type, then_by):
+        rng = np.random.default_rng(3)
+        columns = ItineraryColumns(
+            ids=np.array([f"itinerary_{i}" for i in range(200)]),
+            # Few distinct values so most itineraries tie
+            durations=rng.integers(60, 64, 200),
+            amounts=rng.integers(100, 104, 200).astype(np.float64),
+            currencies=np.zeros(200, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        base = canonical(columns.take(np.arange(150)))
+        merged = ItineraryColumns.concatenate(
+            [base.take(sort_order(base, sorting_type, then_by=then_by)), columns.take(np.arange(150, 200))]
+        )
+        order = merge_order(merged, 150, sorting_type, then_by=then_by, tie_break=merged.row_hashes)
+
+        expected = canonical(columns)
+        expected_order = sort_order(expected, sorting_type, then_by=then_by)
+        assert merged.ids[order].tolist() == expected.ids[expected_order].tolist()
+
+    def test_invalid_sorting_type(self):
+        columns = ItineraryColumns.from_itineraries([])
+        with pytest.raises(ValueError):
+            sort_order(columns, "slowest")
+
+    def test_partial_sort_matches_full_sort_prefix(self):
+        rng = np.random.default_rng(7)
+        columns = ItineraryColumns(
+            ids=np.array([f"itinerary_{i}" for i in range(1000)]),
+            # Few distinct values so the window edge falls on ties
+            durations=rng.integers(60, 80, 1000),
+            amounts=rng.integers(100, 110, 1000).astype(np.float64),
+            currencies=np.zeros(1000, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        for sorting_type in SORT_KEYS:
+            full_order = sort_order(columns, sorting_type)
+            partial_order = sort_order(columns, sorting_type, limit=25)
+            assert partial_order.tolist() == full_order[:25].tolist()
+
+    def test_partial_sort_limit_larger_than_total(self):
+        columns = ItineraryColumns(
+            ids=np.array(["a", "b"]),
+            durations=np.array([2, 1]),
+            amounts=np.array([1.0, 1.0]),
+            currencies=np.zeros(2, dtype=np.int16),
+            rate_table=RateTable({"EUR": 1.0}),
+        )
+        assert sort_order(columns, "fastest", limit=10).tolist() == [1, 0]
+
+
+class TestCaching:
+    def test_fingerprint_ignores_itinerary_order(self):
+        itineraries = [
+            Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
+            Itinerary(id="2", duration_minutes=90, price=Price(amount=80, currency="EUR")),
+        ]
+        request = SortRequest(itineraries=itineraries, sorting_type="cheapest")
+        reversed_request = SortRequest(itineraries=itineraries[::-1], sorting_type="cheapest", price_weight=0.2, duration_weight=0.8)
+        assert request_fingerprint(request) == request_fingerprint(reversed_request)
+
+        # Ids held in wider strings, e.g. joined with longer ones that were filtered out, digest the same
+        columns = ItineraryColumns.from_itineraries(itineraries)
+        widened = ItineraryColumns.concatenate([columns, ItineraryColumns.from_itineraries([
+            Itinerary(id="long_id", duration_minutes=1, price=Price(amount=1, currency="EUR"))
+        ])]).take(np.arange(2))
+        assert widened.ids.dtype != columns.ids.dtype
+        assert request_fingerprint(request, widened) == request_fingerprint(request, columns)
+        assert request_fingerprint(request, ItineraryColumns.from_itineraries([])) != request_fingerprint(request)
+
+    @pytest.mark.usefixtures("fake_redis")
+    def test_ties_are_ordered_the_same_for_every_client(self):
+        client = TestClient(app)
+        itineraries = [
+            {"id": f"itinerary_{i}", "duration_minutes": 100, "price": {"amount": 10 + i % 2, "currency": "EUR"}}
+            for i in range(12)
+        ]
+        first = client.post("/sort_itineraries?page_size=12", json={"sorting_type": "cheapest", "itineraries": itineraries})
+        second = client.post(
+            "/sort_itineraries?page_size=12", json={"sorting_type": "cheapest", "itineraries": itineraries[::-1]}
+        )
+        assert first.json()["cache_key"] == second.json()["cache_key"]
+
+        # The cached order is the one either client gets when sorting on its own
+        uncached = sort_request(parse_sort_request({"sorting_type": "cheapest", "itineraries": itineraries[::-1]}))
+        ids = [item["id"] for item in first.json()["sorted_itineraries"]]
+        assert ids == [item["id"] for item in uncached["sorted_itineraries"][:]]
+
+    def test_itineraries_with_colliding_row_hashes_have_different_fingerprints(self):
+        first = SortRequest(
+            itineraries=[Itinerary(id="a", duration_minutes=0, price=Price(amount=10, currency="EUR"))],
+            sorting_type="cheapest",
+        )
+        second = SortRequest(
+            itineraries=[Itinerary(id="b", duration_minutes=3298534890793, price=Price(amount=10, currency="EUR"))],
+            sorting_type="cheapest",
+        )
+        # Row hashes only order the itineraries, the fingerprint digests every field of them
+        with patch("sorter.api.engine.hash_rows", lambda columns: np.zeros(len(columns), dtype=np.uint64)):
+            assert request_fingerprint(first) != request_fingerprint(second)
+
+    def test_fingerprint_changes_with_weights_and_data(self):
+        itineraries = [
+            Itinerary(id="1", duration_minutes=120, price=Price(amount=100, currency="CZK")),
+            Itinerary(id="2", duration_minutes=90, price=Price(amount=80, currency="EUR")),
+        ]
+        best = SortRequest(itineraries=itineraries, sorting_type="best")
+        reweighted = SortRequest(itineraries=itineraries, sorting_type="best", price_weight=0.2, duration_weight=0.8)
+        changed = SortRequest(itineraries=itineraries[:1], sorting_type="best")
+        fingerprints = {request_fingerprint(request) for request in (best, reweighted, changed)}
+        assert len(fingerprints) == 3
+
+    @pytest.mark.asyncio
+    async def test_concurrent_identical_sorts_are_coalesced(self):
+        calls = []
+
+        async def sort():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"total": 0, "sorted_itineraries": []}
+
+        results = await asyncio.gather(*(coalesce("fingerprint", sort) for _ in range(5)))
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+
+
+class TestIngest:
+    @pytest.fixture
+    def payload(self):
+        return {
+            "sorting_type": "best",
+            "price_weight": 0.3,
+            "duration_weight": 0.7,
+            "itineraries": [
+                {"id": "1", "duration_minutes": 120, "price": {"amount": 100, "currency": "EUR"}},
+                {"id": "2", "duration_minutes": 90, "price": {"amount": 120.5, "currency": "USD"}},
+            ],
+        }
+
+    def assert_same_columns(self, left, right):
+        assert left.ids.tolist() == right.ids.tolist()
+        assert left.durations.tolist() == right.durations.tolist()
+        assert np.allclose(left.price_eur, right.price_eur)
+
+    def test_fast_path_matches_model_validation(self, payload):
+        request = parse_sort_request(json.dumps(payload).encode())
+        model = SortRequest.model_validate(payload)
+
+        assert (request.sorting_type, request.price_weight, request.duration_weight) == ("best", 0.3, 0.7)
+        assert request.payload == payload
+        self.assert_same_columns(request.columns, canonical(ItineraryColumns.from_itineraries(model.itineraries)))
+
+    def test_lax_input_is_coerced_like_the_model(self, payload):
+        payload["itineraries"][0]["duration_minutes"] = "120"
+        payload["itineraries"][1]["price"]["amount"] = "120.5"
+        request = parse_sort_request(payload)
+
+        model = SortRequest.model_validate(payload)
+        self.assert_same_columns(request.columns, canonical(ItineraryColumns.from_itineraries(model.itineraries)))
+
+    def test_long_ids_are_rejected(self, payload):
+        payload["itineraries"][0]["id"] = "x" * (MAX_ID_LENGTH + 1)
+        with pytest.raises(ValidationError) as e:
+            SortRequest.model_validate(payload)
+        assert e.value.errors()[0]["loc"] == ("itineraries", 0, "id")
+
+    @pytest.mark.parametrize("itinerary", [
+        {"id": "1", "duration_minutes": -1, "price": {"amount": 100, "currency": "EUR"}},
+        {"id": "1", "duration_minutes": 120, "price": {"amount": 100, "currency": "XXX"}},
+        {"id": "1", "duration_minutes": 120, "price": {"amount": "abc", "currency": "EUR"}},
+        {"id": "1", "price": {"amount": 100, "currency": "EUR"}},
+        {"id": "x" * (MAX_ID_LENGTH + 1), "duration_minutes": 120, "price": {"amount": 100, "currency": "EUR"}},
+        {"id": "1", "duration_minutes": 120, "price": {"amount": "\u0661\u0662", "currency": "EUR"}},
+    ])
+    def test_invalid_input_raises_model_errors(self, payload, itinerary):
+        payload["itineraries"].append(itinerary)
+        with pytest.raises(RequestValidationError) as e:
+            parse_sort_request(payload)
+
+        with pytest.raises(ValidationError) as expected:
+            SortRequest.model_validate(payload)
+        assert [error["loc"] for error in e.value.errors()] == [
+            ("body", *error["loc"]) for error in expected.value.errors()
+        ]
+
+    def test_batch_job_is_parsed_once(self, payload):
+        job = {**payload, "sorting_types": ["cheapest", "best"]}
+        del job["sorting_type"]
+        (cheapest, best), = parse_batch_sort_request({"jobs": [job]})
+
+        assert (cheapest.sorting_type, best.sorting_type, best.price_weight) == ("cheapest", "best", 0.3)
+        assert cheapest.columns is best.columns
+        assert best.payload == {**payload, "then_by": []}
+
+        job["itineraries"][0]["duration_minutes"] = "120"
+        (cheapest, best), = parse_batch_sort_request({"jobs": [job]})
+        assert cheapest.columns is best.columns
+
+    def test_invalid_json(self):
+        with pytest.raises(RequestValidationError) as e:
+            parse_sort_request(b'{"sorting_type": ')
+        assert e.value.errors()[0]["type"] == "json_invalid"
+
+
+@pytest.mark.usefixtures("fake_redis")
+class TestStreaming:
+    @pytest.fixture
+    def itineraries(self):
+        return [
+            {"id": str(i), "duration_minutes": 100 - i, "price": {"amount": i + 1, "currency": "USD"}}
+            for i in range(25)
+        ]
+
+    @staticmethod
+    async def chunks(body: bytes, size: int = 7):
+        for start in range(0, len(body), size):
+            yield body[start:start + size]
+
+    @pytest.mark.asyncio
+    async def test_ndjson_batches_match_json_request(self, itineraries):
+        body = b"\n".join(json.dumps(itinerary).encode() for itinerary in itineraries) + b"\n"
+        request = await parse_ndjson_sort_request(self.chunks(body), {"sorting_type": "best"}, batch_size=10)
+
+        expected = parse_sort_request({"sorting_type": "best", "itineraries": itineraries})
+        assert request.columns.ids.tolist() == expected.columns.ids.tolist()
+        assert np.allclose(request.columns.price_eur, expected.columns.price_eur)
+        prices = {itinerary["id"]: itinerary["price"] for itinerary in request.as_payload()["itineraries"]}
+        assert prices["3"] == {"amount": 4.0, "currency": "USD"}
+
+    def test_then_by_in_body_and_query(self, itineraries):
+        client = TestClient(app)
+        for itinerary in itineraries:
+            itinerary["duration_minutes"] = 100 + int(itinerary["id"]) % 3
+        response = client.post("/sort_itineraries?page_size=4", json={
+            "sorting_type": "fastest", "then_by": ["-price_eur"], "itineraries": itineraries
+        })
+        assert [item["id"] for item in response.json()["sorted_itineraries"]] == ["24", "21", "18", "15"]
+
+        body = b"\n".join(json.dumps(itinerary).encode() for itinerary in itineraries)
+        streamed = client.post(
+            "/sort_itineraries?sorting_type=fastest&then_by=-price_eur&page_size=4",
+            content=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+        assert streamed.json()["cache_key"] == response.json()["cache_key"]
+
+        response = client.post("/sort_itineraries", json={
+            "sorting_type": "fastest", "then_by": ["weight"], "itineraries": itineraries
+        })
+        assert response.status_code == 422
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("field, value", [("duration_minutes", -1), ("id", "x" * (MAX_ID_LENGTH + 1))])
+    async def test_ndjson_errors_are_located_by_line(self, itineraries, field, value):
+        itineraries[12][field] = value
+        body = b"\n".join(json.dumps(itinerary).encode() for itinerary in itineraries)
+        with pytest.raises(RequestValidationError) as e:
+            await parse_ndjson_sort_request(self.chunks(body), {"sorting_type": "best"}, batch_size=10)
+        assert [error["loc"] for error in e.value.errors()] == [("body", 12, field)]
+
+    def test_filters_and_fields(self, itineraries):
+        client = TestClient(app)
+        options = {
+            "sorting_type": "cheapest",
+            "filters": {"max_duration_minutes": 90, "currencies": ["USD"], "ids": [str(i) for i in range(0, 25, 2)]},
+            "fields": ["id", "price"],
+        }
+        response = client.post("/sort_itineraries?page_size=4", json={**options, "itineraries": itineraries})
+        assert response.status_code == 200
+        kept = [
+            itinerary for itinerary in itineraries
+            if itinerary["duration_minutes"] <= 90 and int(itinerary["id"]) % 2 == 0
+        ]
+        assert response.json()["total"] == len(kept) == 8
+        assert set(response.json()["sorted_itineraries"][0]) == {"id", "price"}
+
+        # Sending only the kept itineraries sorts the same ones, under another key since the filters
+        # aren't applied to its deltas
+        prefiltered = client.post("/sort_itineraries?page_size=4", json={
+            "sorting_type": "cheapest", "fields": ["id", "price"], "itineraries": kept
+        })
+        assert prefiltered.json()["sorted_itineraries"] == response.json()["sorted_itineraries"]
+        assert prefiltered.json()["cache_key"] != response.json()["cache_key"]
+
+        body = b"\n".join(json.dumps(itinerary).encode() for itinerary in itineraries)
+        streamed = client.post(
+            "/sort_itineraries",
+            params={"sorting_type": "cheapest", "filters": json.dumps(options["filters"]), "fields": "id,price",
+                    "page_size": 4},
+            content=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+        assert streamed.json()["cache_key"] == response.json()["cache_key"]
+
+        # Projected results can't be updated, the dropped fields are needed to merge
+        delta = client.post(f"/sort_itineraries/{response.json()['cache_key']}/delta", json={"add": []})
+        assert delta.status_code == 409
+
+        response = client.post("/sort_itineraries", json={**options, "fields": ["weight"], "itineraries": itineraries})
+        assert response.status_code == 422
+
+    def test_ndjson_in_and_out(self, itineraries):
+        client = TestClient(app)
+        body = b"\n".join(json.dumps(itinerary).encode() for itinerary in itineraries)
+        response = client.post(
+            "/sort_itineraries?sorting_type=fastest&page_size=5",
+            content=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+        assert response.status_code == 200
+        assert [item["id"] for item in response.json()["sorted_itineraries"]] == ["24", "23", "22", "21", "20"]
+
+        streamed = client.get(response.json()["next"], headers={"accept": "application/x-ndjson"})
+        assert streamed.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(line)["id"] for line in streamed.text.splitlines()] == [str(i) for i in range(24, -1, -1)]
+
+        streamed = client.post(
+            "/sort_itineraries",
+            json={"sorting_type": "fastest", "itineraries": itineraries},
+            headers={"accept": "application/x-ndjson"},
+        )
+        assert [json.loads(line)["id"] for line in streamed.text.splitlines()] == [str(i) for i in range(24, -1, -1)]
+
+
+@pytest.mark.usefixtures("fake_redis")
+class TestDelta:
+    def test_delta_matches_sorting_the_whole_list(self):
+        client = TestClient(app)
+        itineraries = [
+            {"id": str(i), "duration_minutes": 100 + i, "price": {"amount": 50 + (i * 37) % 101, "currency": "EUR"}}
+            for i in range(150)
+        ]
+        response = client.post("/sort_itineraries", json={"sorting_type": "best", "itineraries": itineraries})
+        cache_key = response.json()["cache_key"]
+
+        added = [
+            {"id": "fast", "duration_minutes": 10, "price": {"amount": 1000, "currency": "EUR"}},
+            {"id": "cheap", "duration_minutes": 400, "price": {"amount": 5, "currency": "USD"}},
+        ]
+        response = client.post(f"/sort_itineraries/{cache_key}/delta?page_size=200", json={
+            "add": added, "remove": ["0", "1"]
+        })
+        assert response.status_code == 200
+        assert response.json()["cache_key"] != cache_key
+
+        expected = sort_request(parse_sort_request({
+            "sorting_type": "best", "itineraries": itineraries[2:] + added
+        }))["sorted_itineraries"][:]
+        assert [item["id"] for item in response.json()["sorted_itineraries"]] == [item["id"] for item in expected]
+
+    def test_filters_only_apply_to_the_deltas_of_filtered_results(self):
+        client = TestClient(app)
+        itineraries = [
+            {"id": str(i), "duration_minutes": 100, "price": {"amount": 10 * i, "currency": "EUR"}}
+            for i in range(10)
+        ]
+        kept = [itinerary for itinerary in itineraries if itinerary["price"]["amount"] <= 50]
+        filtered = client.post("/sort_itineraries", json={
+            "sorting_type": "cheapest", "filters": {"max_price_eur": 50}, "itineraries": itineraries
+        }).json()
+        unfiltered = client.post("/sort_itineraries", json={"sorting_type": "cheapest", "itineraries": kept}).json()
+        assert filtered["total"] == unfiltered["total"] == 6
+        assert filtered["cache_key"] != unfiltered["cache_key"]
+
+        added = {"add": [{"id": "expensive", "duration_minutes": 100, "price": {"amount": 500, "currency": "EUR"}}]}
+        response = client.post(f"/sort_itineraries/{unfiltered['cache_key']}/delta?page_size=10", json=added)
+        assert response.json()["total"] == 7
+        assert response.json()["sorted_itineraries"][-1]["id"] == "expensive"
+        response = client.post(f"/sort_itineraries/{filtered['cache_key']}/delta", json=added)
+        assert response.json()["total"] == 6
+        assert response.json()["cache_key"] == filtered["cache_key"]
+
+    def test_unknown_result(self):
+        response = TestClient(app).post("/sort_itineraries/missing/delta", json={"add": []})
+        assert response.status_code == 404
+
+
+@pytest.mark.usefixtures("fake_redis")
+class TestBatch:
+    def test_results_match_single_requests(self):
+        client = TestClient(app)
+        itineraries = [
+            {
+                "id": str(i),
+                "duration_minutes": 100 + (i * 13) % 50,
+                "price": {"amount": 50 + (i * 37) % 101, "currency": "EUR"},
+            }
+            for i in range(150)
+        ]
+        response = client.post("/sort_itineraries/batch?page_size=5", json={"jobs": [
+            {"sorting_types": ["cheapest", "fastest", "best"], "itineraries": itineraries},
+            {"sorting_types": ["best"], "price_weight": 0.2, "duration_weight": 0.8, "itineraries": itineraries[:20]},
+        ]})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [[result["sorting_type"] for result in job] for job in results] == [
+            ["cheapest", "fastest", "best"], ["best"]
+        ]
+
+        for result, weights, job_itineraries in [
+            *((result, (0.5, 0.5), itineraries) for result in results[0]),
+            (results[1][0], (0.2, 0.8), itineraries[:20]),
+        ]:
+            single = client.post("/sort_itineraries?page_size=5", json={
+                "sorting_type": result["sorting_type"],
+                "price_weight": weights[0],
+                "duration_weight": weights[1],
+                "itineraries": job_itineraries,
+            }).json()
+            assert result == single
+
+        # Pages past the sorted window of a batch result are sorted from the stored job
+        last_page = client.get("/sort_itineraries", params={
+            "cache_key": results[0][2]["cache_key"], "page": 30, "page_size": 5
+        })
+        assert len(last_page.json()["sorted_itineraries"]) == 5
+
+    def test_invalid_job(self):
+        response = TestClient(app).post("/sort_itineraries/batch", json={
+            "jobs": [{"sorting_types": ["slowest"], "itineraries": []}]
+        })
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["body", "jobs", 0, "sorting_types", 0]
+
+
+@pytest.mark.usefixtures("fake_redis")
+class TestStorage:
+    @pytest.mark.asyncio
+    async def test_page_is_read_without_loading_the_whole_result(self, fake_redis):
+        sorted_itineraries = [
+            json.dumps({"id": str(i), "duration_minutes": i, "price": {"amount": 1.0, "currency": "EUR"}}).encode()
+            for i in range(25)
+        ]
+        await storage.store_sorted_itineraries("key", sorted_itineraries, 25)
+
+        meta, page = await storage.load_page("key", 10, 20)
+        assert meta == {"total": 25, "sorted": 25}
+        assert page == sorted_itineraries[10:20]
+        assert fake_redis.llen(storage.result_key("key")) == 25
+        assert fake_redis.ttl(storage.result_key("key")) == storage.CACHE_TTL
+
+    @pytest.mark.asyncio
+    async def test_columnar_encoding(self, fake_redis):
+        columns = ItineraryColumns(
+            ids=np.array([f"itinerary_{i}" for i in range(600)]),
+            durations=np.arange(600, dtype=np.int64),
+            amounts=np.linspace(10, 500, 600),
+            currencies=np.arange(600, dtype=np.int16) % 3,
+            rate_table=RateTable({"EUR": 1.0, "USD": 0.9, "CZK": 0.04}),
+        )
+        sorted_itineraries = SortedItineraries(columns, np.arange(600)[::-1])
+        serialized = sorted_itineraries.serialize()
+        await storage.store_sorted_itineraries("key", serialized, 600)
+        await storage.store_sorted_itineraries("key", sorted_itineraries, 600, encoding="columnar")
+
+        # Pages across chunk boundaries read the same items as the JSON encoding
+        for start, end in [(0, 10), (250, 270), (590, 610), (0, 600)]:
+            meta, page = await storage.load_page("key", start, end, refresh_ttl=True)
+            assert page == serialized[start:end]
+        assert meta == {"total": 600, "sorted": 600, "encoding": "columnar", "chunk_size": codec.CHUNK_SIZE}
+        assert not fake_redis.exists(storage.result_key("key"))
+        assert fake_redis.ttl(storage.chunks_key("key")) == storage.CACHE_TTL
+        assert sum(map(len, fake_redis.lrange(storage.chunks_key("key"), 0, -1))) * 3 < sum(map(len, serialized))
+
+        # Projected results keep every field in the chunks and drop the others when decoded
+        projected = SortedItineraries(columns, np.arange(600), ["id"])
+        await storage.store_sorted_itineraries("projected", projected, 600, encoding="columnar")
+        assert (await storage.load_page("projected", 300, 302))[1] == projected.serialize(slice(300, 302))
+
+        # Serialized items are encoded the same, results stored with another chunk size can still be read
+        with patch("sorter.api.codec.CHUNK_SIZE", 100):
+            await storage.store_sorted_itineraries("key", serialized, 600, encoding="columnar")
+        assert (await storage.load_page("key", 95, 105))[1] == serialized[95:105]
+
+    @pytest.mark.asyncio
+    async def test_only_the_lock_holder_releases_the_lock(self, fake_redis):
+        token = await storage.acquire_lock("key")
+        assert token and await storage.acquire_lock("key") is None
+
+        await storage.release_lock("key", "another token")
+        assert await storage.is_locked("key")
+        await storage.release_lock("key", token)
+        assert not await storage.is_locked("key")
+
+        # A sort that gave up waiting on another process sorts without taking over or releasing its lock
+        other = await storage.acquire_lock("key")
+        request = parse_sort_request({
+            "sorting_type": "cheapest",
+            "itineraries": [{"id": "1", "duration_minutes": 60, "price": {"amount": 10, "currency": "EUR"}}],
+        })
+        with patch("sorter.main.wait_for_sorted_itineraries", return_value=None):
+            meta = await sort_and_store("key", request, limit=10)
+        assert meta["total"] == 1
+        assert fake_redis.get(storage.lock_key("key")) == other.encode()
+
+    @pytest.mark.asyncio
+    async def test_missing_result(self):
+        assert await storage.load_page("missing", 0, 10) == (None, [])
+        assert not await storage.has_sorted_itineraries("missing")
+
+    @pytest.mark.asyncio
+    async def test_partial_result_is_completed_when_paging_past_the_window(self):
+        request = SortRequest(
+            itineraries=[
+                Itinerary(id=str(i), duration_minutes=100 - i, price=Price(amount=100, currency="EUR"))
+                for i in range(30)
+            ],
+            sorting_type="fastest"
+        )
+        response = sort_request(request, limit=10)
+        await storage.store_sorted_itineraries(
+            "key", response["sorted_itineraries"].serialize(), response["total"], request=request.model_dump()
+        )
+        assert await storage.load_meta("key") == {"total": 30, "sorted": 10}
+
+        meta, page = await read_page("key", page=3, page_size=10)
+        assert (meta["total"], meta["sorted"], meta["options"]["sorting_type"]) == (30, 30, "fastest")
+        assert [json.loads(item)["id"] for item in page] == [str(i) for i in range(9, -1, -1)]
+
+        # Requests stored from their columns are completed the same as JSON payloads
+        await storage.store_sorted_itineraries(
+            "columns", response["sorted_itineraries"].serialize(), response["total"],
+            request=parse_sort_request(request.model_dump()).dumps(),
+        )
+        assert (await read_page("columns", page=3, page_size=10))[1] == page
+
+
+@pytest.mark.usefixtures("fake_redis")
+class TestTasks:
+    @pytest.fixture
+    def client(self):
+        return TestClient(app)
+
+    @pytest.fixture
+    def payload(self):
+        return {
+            "sorting_type": "fastest",
+            "itineraries": [
+                {"id": str(i), "duration_minutes": 100 - i, "price": {"amount": 100.0, "currency": "EUR"}}
+                for i in range(15)
+            ],
+        }
+
+    def test_tasks_are_sent_off_the_event_loop(self, client, payload):
+        def send(*args):
+            with pytest.raises(RuntimeError):
+                asyncio.get_running_loop()
+
+        with patch("sorter.api.v1.tasks.sort_task") as mock_sort_task:
+            mock_sort_task.send.side_effect = send
+            assert client.post("/sort_itineraries?schedule_task=true", json=payload).json()["task_url"]
+            assert mock_sort_task.send.call_count == 1
+
+    def test_scheduled_task_status_and_paginated_result(self, client, fake_redis, payload):
+        with patch("sorter.api.v1.tasks.sort_task") as mock_sort_task:
+            task_url = client.post("/sort_itineraries?schedule_task=true", json=payload).json()["task_url"]
+            # An identical request shares the task instead of scheduling another one
+            assert client.post("/sort_itineraries?schedule_task=true", json=payload).json()["task_url"] == task_url
+            assert mock_sort_task.send.call_count == 1
+            task_id, request_data = mock_sort_task.send.call_args.args
+
+        response = client.get(task_url)
+        assert response.status_code == 202
+        assert response.json() == {"task_id": task_id, "status": "pending", "detail": None}
+
+        sort_task.fn(task_id, request_data)
+        keys_before = set(fake_redis.keys())
+        response = client.get(task_url, params={"page": 2, "page_size": 10})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["total"] == 15
+        assert [item["id"] for item in body["sorted_itineraries"]] == ["4", "3", "2", "1", "0"]
+        assert body["previous"] == f"{task_url}?page=1&page_size=10"
+        # Reading a page refreshes the TTL and does not copy the result
+        assert set(fake_redis.keys()) == keys_before
+        assert fake_redis.ttl(storage.result_key(task_id)) == storage.CACHE_TTL
+
+    def test_failed_task(self, client, fake_redis, payload):
+        storage.queue_status(fake_redis, "task", "pending")
+        payload["sorting_type"] = "slowest"
+        with pytest.raises(Exception):
+            sort_task.fn("task", payload)
+
+        response = client.get("/sort_itineraries/task")
+        assert response.status_code == 200
+        assert response.json()["status"] == "failed"
+
+    def test_unknown_task(self, client):
+        assert client.get("/sort_itineraries/missing").status_code == 404
+
+    def test_large_payload_is_sent_by_reference(self, client, fake_redis, payload):
+        with patch("sorter.api.v1.tasks.sort_task") as mock_sort_task, \
+                patch("sorter.main.TASK_PAYLOAD_REFERENCE_MIN_ITINERARIES", 10):
+            task_url = client.post("/sort_itineraries?schedule_task=true", json=payload).json()["task_url"]
+            task_id, = mock_sort_task.send.call_args.args
+
+        sort_task.fn(task_id)
+        assert [item["id"] for item in client.get(task_url).json()["sorted_itineraries"]][:3] == ["14", "13", "12"]
+        # The stored payload is dropped with the result
+        assert not fake_redis.exists(storage.request_key(task_id))
+
+    def test_streamed_payload_is_stored_from_its_columns(self, client, fake_redis, payload):
+        body = b"\n".join(json.dumps(itinerary).encode() for itinerary in payload["itineraries"])
+        with patch("sorter.api.v1.tasks.sort_task") as mock_sort_task, \
+                patch("sorter.main.TASK_PAYLOAD_REFERENCE_MIN_ITINERARIES", 10), \
+                patch.object(ColumnarSortRequest, "as_payload") as as_payload:
+            task_url = client.post(
+                f"/sort_itineraries?schedule_task=true&sorting_type={payload['sorting_type']}",
+                content=body,
+                headers={"content-type": "application/x-ndjson"},
+            ).json()["task_url"]
+            task_id, = mock_sort_task.send.call_args.args
+            assert b'"itineraries"' not in fake_redis.get(storage.request_key(task_id))
+
+            sort_task.fn(task_id)
+        as_payload.assert_not_called()
+
+        expected = [json.loads(item) for item in sort_request(parse_sort_request(payload))["sorted_itineraries"].serialize()]
+        assert client.get(f"{task_url}?page_size=15").json()["sorted_itineraries"] == expected
+
+    def test_batch_worker(self, fake_redis, payload):
+        broker = StubBroker()
+        broker.declare_queue(sort_task.queue_name)
+        storage.queue_request(fake_redis, "referenced", payload)
+        broker.enqueue(sort_task.message("inline", payload))
+        broker.enqueue(sort_task.message("referenced"))
+        broker.enqueue(sort_task.message("expired"))
+        broker.enqueue(sort_task.message("invalid", {**payload, "sorting_type": "slowest"}))
+
+        consumer = broker.consume(sort_task.queue_name, prefetch=10, timeout=10)
+        messages = worker.next_batch(consumer, 10)
+        assert len(messages) == 4
+        worker.process_batch(consumer, messages)
+
+        statuses = [storage.get_sync_redis().get(storage.status_key(task_id)) for task_id in (
+            "inline", "referenced", "expired", "invalid"
+        )]
+        assert [json.loads(status)["status"] for status in statuses] == ["done", "done", "failed", "failed"]
+        assert fake_redis.lrange(storage.result_key("referenced"), 0, 0) == [
+            b'{"id":"14","duration_minutes":86,"price":{"amount":100.0,"currency":"EUR"}}'
+        ]
+        assert [message.message_id for message in broker.dead_letters] == [
+            message.message_id for message in messages[2:]
+        ]
+
+
+@pytest.mark.usefixtures("fake_redis")
+class TestAdmission:
+    @pytest.fixture
+    def payload(self):
+        return {
+            "sorting_type": "cheapest",
+            "itineraries": [
+                {"id": str(i), "duration_minutes": 100, "price": {"amount": 100 - i, "currency": "EUR"}}
+                for i in range(20)
+            ],
+        }
+
+    def test_oversized_requests_are_scheduled(self, payload):
+        client = TestClient(app)
+        with patch("sorter.main.SYNC_SORT_MAX_ITINERARIES", 10), \
+                patch("sorter.api.v1.tasks.sort_task") as mock_sort_task:
+            response = client.post("/sort_itineraries", json=payload)
+            assert response.status_code == 202
+            task_id, request_data = mock_sort_task.send.call_args.args
+            assert response.json()["task_url"].endswith(f"/sort_itineraries/{task_id}")
+
+            # Identical requests share the pending task, once it is done they are served from its result
+            assert client.post("/sort_itineraries", json=payload).status_code == 202
+            sort_task.fn(task_id, request_data)
+            response = client.post("/sort_itineraries", json=payload)
+        assert mock_sort_task.send.call_count == 1
+        assert response.status_code == 200
+        assert response.json()["sorted_itineraries"][0]["id"] == "19"
+
+    def test_full_queue_is_retried_later(self, fake_redis, payload):
+        fake_redis.rpush(storage.queue_key("default"), "message_1", "message_2")
+        client = TestClient(app)
+        with patch("sorter.main.MAX_QUEUE_DEPTH", 2), patch("sorter.api.v1.tasks.sort_task") as mock_sort_task:
+            response = client.post("/sort_itineraries?schedule_task=true", json=payload)
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == str(RETRY_AFTER)
+        mock_sort_task.send.assert_not_called()
+        # The request wasn't marked pending, it can be scheduled once the queue drains
+        task_id = request_fingerprint(parse_sort_request(payload))
+        assert client.get(f"/sort_itineraries/{task_id}").status_code == 404
+
+    def test_concurrent_sorts_are_capped(self, payload):
+        executor.start("thread", workers=1, max_running=0)
+        try:
+            with patch("sorter.api.executor.INLINE_SORT_MAX_ITINERARIES", 0):
+                response = TestClient(app).post("/sort_itineraries", json=payload)
+        finally:
+            executor.shutdown()
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == str(RETRY_AFTER)
+
+    def test_page_size_is_capped(self, payload):
+        response = TestClient(app).post(f"/sort_itineraries?page_size={MAX_PAGE_SIZE + 1}", json=payload)
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["query", "page_size"]
+
+
+class TestExecutor:
+    @pytest.fixture
+    def request_data(self):
+        return SortRequest(
+            itineraries=[
+                Itinerary(id=str(i), duration_minutes=100 - i, price=Price(amount=100, currency="EUR"))
+                for i in range(20)
+            ],
+            sorting_type="fastest"
+        )
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("mode", ["inline", "thread", "process"])
+    async def test_offloaded_sort_matches_inline_sort(self, mode, request_data):
+        executor.start(mode, workers=1)
+        try:
+            with patch("sorter.api.executor.INLINE_SORT_MAX_ITINERARIES", 0):
+                response = await sort_request_offloaded(request_data, limit=5)
+        finally:
+            executor.shutdown()
+        assert response["total"] == 20
+        assert response["sorted_itineraries"][:] == sort_request(request_data, limit=5)["sorted_itineraries"][:]
+
+    @pytest.mark.asyncio
+    async def test_small_payloads_run_inline(self, request_data):
+        executor.start("thread", workers=1)
+        try:
+            with patch.object(asyncio.get_running_loop(), "run_in_executor") as mock_run_in_executor:
+                await sort_request_offloaded(request_data)
+            mock_run_in_executor.assert_not_called()
+        finally:
+            executor.shutdown()
+
+    @pytest.mark.usefixtures("fake_redis")
+    @pytest.mark.parametrize("mode", ["thread", "process"])
+    def test_requests_are_handled_in_the_pool(self, mode, request_data):
+        client = TestClient(app)
+        payload = request_data.model_dump()
+        expected = [json.loads(item) for item in sort_request(request_data)["sorted_itineraries"].serialize()]
+        executor.start(mode, workers=1)
+        try:
+            with patch("sorter.api.executor.INLINE_SORT_MAX_ITINERARIES", 0), patch("sorter.main.TOP_K_WINDOW", 5):
+                first = client.post("/sort_itineraries?page_size=5", json=payload).json()
+                # Paging past the sorted window sorts the rest from the stored request
+                last = client.get(f"/sort_itineraries?cache_key={first['cache_key']}&page=4&page_size=5").json()
+                invalid = client.post("/sort_itineraries", json={**payload, "sorting_type": "slowest"})
+        finally:
+            executor.shutdown()
+        assert first["sorted_itineraries"] + last["sorted_itineraries"] == expected[:5] + expected[15:]
+        assert invalid.status_code == 422
+
+    @pytest.mark.usefixtures("fake_redis")
+    def test_parsing_fingerprinting_and_encoding_leave_the_event_loop(self, request_data):
+        threads = {}
+
+        def record(name, func):
+            def wrapper(*args, **kwargs):
+                threads[name] = threading.current_thread().name
+                return func(*args, **kwargs)
+            return wrapper
+
+        parse, fingerprint = endpoints.parse_sort_request, endpoints.fingerprint
+        encode = storage.encode_sorted_itineraries
+        executor.start("thread", workers=1)
+        try:
+            with patch("sorter.api.executor.INLINE_SORT_MAX_ITINERARIES", 0), \
+                    patch.object(endpoints, "parse_sort_request", record("parse", parse)), \
+                    patch.object(endpoints, "fingerprint", record("fingerprint", fingerprint)), \
+                    patch.object(storage, "encode_sorted_itineraries", record("encode", encode)):
+                TestClient(app).post("/sort_itineraries", json=request_data.model_dump())
+        finally:
+            executor.shutdown()
+        assert set(threads) == {"parse", "fingerprint", "encode"}
+        assert all(name.startswith("sorter") for name in threads.values())
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            executor.start("gpu")
+
+
+class TestMetrics:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("mode", ["thread", "process"])
+    async def test_stages_run_in_the_executor_are_collected(self, mode):
+        request = SortRequest(
+            itineraries=[Itinerary(id="1", duration_minutes=100, price=Price(amount=100, currency="USD"))],
+            sorting_type="best"
+        )
+        executor.start(mode, workers=1)
+        try:
+            with patch("sorter.api.executor.INLINE_SORT_MAX_ITINERARIES", 0), metrics.collect() as timings:
+                await sort_request_offloaded(request)
+        finally:
+            executor.shutdown()
+        assert {"conversion", "scoring", "sorting"} <= set(timings.stages)
+
+    def test_server_timing_header(self):
+        stage_app = FastAPI()
+
+        @stage_app.get("/")
+        async def root():
+            with metrics.stage("sorting"):
+                metrics.describe("fastest", 10)
+            return {}
+
+        response = TestClient(metrics.MetricsMiddleware(stage_app, server_timing=True)).get("/")
+        assert response.headers["server-timing"].startswith("sorting;dur=")
+        response = TestClient(metrics.MetricsMiddleware(stage_app)).get("/")
+        assert "server-timing" not in response.headers
+
+    @pytest.mark.usefixtures("fake_redis")
+    def test_metrics_endpoint(self):
+        client = TestClient(app)
+        client.post("/sort_itineraries", json={
+            "sorting_type": "cheapest",
+            "itineraries": [{"id": "1", "duration_minutes": 100, "price": {"amount": 100, "currency": "EUR"}}],
+        })
+
+        response = client.get("/metrics")
+        assert 'sorter_requests_total{size_bucket="1k",sorting_type="cheapest"}' in response.text
+        assert 'stage="validation"' in response.text
+        assert metrics.size_bucket(1_000_000) == "1M" and metrics.size_bucket(1_000_001) == "inf"
+
+
+class TestBenchmark:
+    def test_payload_is_seeded(self):
+        payload = generate_payload(20, currencies=["EUR", "USD"], currency_weights=[1, 0], seed=1)
+        assert payload == generate_payload(20, currencies=["EUR", "USD"], currency_weights=[1, 0], seed=1)
+        assert {itinerary["price"]["currency"] for itinerary in payload["itineraries"]} == {"EUR"}
+
+    @pytest.mark.asyncio
+    async def test_every_stage_is_measured(self):
+        results = await benchmark.run_benchmark([50], ["best"], repeat=2)
+        assert list(results) == [f"50/best/{stage}" for stage in benchmark.STAGES]
+        assert all(result["p50_ms"] <= result["p99_ms"] for result in results.values())
+
+    def test_entry_points_defer_heavy_imports(self):
+        # The API loads Dramatiq when it schedules a task, the worker only loads FastAPI for invalid requests
+        assert "dramatiq" not in benchmark.import_module("sorter.main")["modules"]
+        worker = benchmark.import_module("sorter.api.v1.worker")
+        assert "fastapi" not in worker["modules"]
+        assert worker["ms"] > 0
+
+    def test_compare_reports_regressions_over_the_tolerance(self):
+        baseline = {"1000/best/sort": {"p50_ms": 10.0, "peak_mb": 5.0}}
+        assert benchmark.compare({"1000/best/sort": {"p50_ms": 11.5, "peak_mb": 5.5}}, baseline) == []
+        assert benchmark.compare({"1000/best/sort": {"p50_ms": 20.0, "peak_mb": 5.0}}, baseline) == [
+            "1000/best/sort p50_ms: 10.0 -> 20.0"
+        ]